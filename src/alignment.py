@@ -1,11 +1,13 @@
-import sys
+import sys, array
+import multiprocessing
 
 import checklist as cl
 import relation as rel
 import articulation as art
 import intension
 import dribble
-from intension import choose_best_match
+import traverse
+import particles as ps
 
 # For each B-record, we choose an articulation with the closest
 # A-record that it matches (preferably but not necessarily an '='
@@ -22,7 +24,15 @@ def align(B, A):
   # Extensional analysis
   cross_mrcas = analyze_cross_mrcas(B, A, tipwards)
   dribble.log("# Number of cross-mrcas: %s" % len(cross_mrcas))
-  ext_map = extensional_match_map(A, B, tipwards, cross_mrcas)
+  particles = ps.ParticleSets(A, B, tipwards, cross_mrcas)
+  if cl.jobs > 1:
+    ext_matches = extensional_matches_in_partitions(B, A, tipwards,
+                                                    cross_mrcas, particles,
+                                                    cl.jobs)
+  else:
+    ext_matches = {}
+  ext_map = extensional_match_map(A, B, tipwards, cross_mrcas, particles,
+                                  ext_matches)
   dribble.log("# Number of extensional relationships: %s" % len(ext_map))
 
   # Add extensional matches to a draft that already has intensional matches
@@ -37,43 +47,40 @@ def assemble_alignment(draft, best, ext_map):
   return draft
 
 def alignment_step(node, best, ext_map, draft):
+  # Walks up both lineages together, one proclamation per step
   def luup(x, y):
-    if x == cl.forest_tnu or y == cl.forest_tnu: return
-    assert cl.get_checklist(x) != cl.get_checklist(y)
-    if in_chain(x, y0) and in_chain(y, x0):
+    while x != cl.forest_tnu and y != cl.forest_tnu:
+      assert cl.get_checklist(x) != cl.get_checklist(y)
+      if not (in_chain(x, y0) and in_chain(y, x0)): return
       bar = best.get(x)
       if bar and find_in_chain(bar.cod, y, x0):
         if bar.cod == y:
           art.proclaim(draft, art.change_relation(bar, rel.eq, "extensional"))
-          luup(cl.get_parent(x), cl.get_parent(y))
+          (x, y) = (cl.get_parent(x), cl.get_parent(y))
         else:
           art.proclaim(draft, art.extensional(y, x, rel.lt, "presumed 0"))
-          luup(x, cl.get_parent(y))
+          y = cl.get_parent(y)
       else:
         bar = best.get(y)
         if bar and find_in_chain(bar.cod, x, y0):
           if bar.cod == y:
             art.proclaim(draft, bar)
-            luup(cl.get_parent(x), cl.get_parent(y))
+            (x, y) = (cl.get_parent(x), cl.get_parent(y))
           else:
             art.proclaim(draft, art.extensional(x, y, rel.lt, "presumed 1"))
-            luup(cl.get_parent(x), y)
+            x = cl.get_parent(x)
         else:
           # neither x nor y matches by name
           art.proclaim(draft, art.extensional(x, y, rel.eq, "presumed mutual"))
-          luup(cl.get_parent(x), cl.get_parent(y))
+          (x, y) = (cl.get_parent(x), cl.get_parent(y))
 
   # See is b is in the chain (matching nodes in lineage)
   def find_in_chain(b, y, x0):
-    if y == cl.forest_tnu:
-      return False
-    elif in_chain(y, x0):
+    while y != cl.forest_tnu and in_chain(y, x0):
       if b == y:
         return True
-      else:
-        return find_in_chain(b, cl.get_parent(y), x0)
-    else:
-      return False
+      y = cl.get_parent(y)
+    return False
 
   def in_chain(y, x0):
     if y in draft: return
@@ -97,11 +104,28 @@ def alignment_step(node, best, ext_map, draft):
 
 # Suppress < transitivity
 
-def extensional_match_map(A, B, draft, xmrcas):
-  ext = {}
+# 'known' has extensional matches already worked out (see
+# extensional_matches_in_partitions), as ((cod, relation name, reason)
+# or None, log messages) for each node.  The messages are logged here,
+# so that the log comes out as if each match had been worked out in
+# the course of the walk.
+
+def extensional_match_map(A, B, draft, xmrcas, particles, known = None):
+  if known == None: known = {}
+  ext = art.Alignment()
+  # Returns the 'less' to pass down to node's children
   def process(node, less):
     if not draft.get(node):
-      e = extensional_match(node, xmrcas)
+      if node in known:
+        (e, messages) = known[node]
+        if e:
+          (cod, relation_name, reason) = e
+          e = art.extensional(node, cod, rel.relations_by_name[relation_name],
+                              reason)
+        for message in messages:
+          dribble.log(message)
+      else:
+        e = extensional_match(node, xmrcas, particles)
       if e:
         if e.relation == rel.lt:
           if less and e.cod == less.cod:
@@ -116,17 +140,98 @@ def extensional_match_map(A, B, draft, xmrcas):
           ext[node] = e
       else:
         less = None
-    for child in cl.get_children(node):
-      process(child, less)
-  for root in cl.get_roots(A): process(root, None)
-  for root in cl.get_roots(B): process(root, None)
+    return less
+  traverse.walk(cl.get_roots(A), cl.get_children, pre=process)
+  traverse.walk(cl.get_roots(B), cl.get_children, pre=process)
   return ext
 
+# ---------- Partitions
+
+# The particle-set comparisons in extensional_match take most of the
+# time, and depend only on the cross-mrcas.  So they can be done for
+# many nodes at once, in a process pool, before extensional_match_map's
+# walk needs them.
+
+# A partition is a B-node and an A-node that are each other's
+# cross-mrca: a clade whose nodes' matches (nearly) all lie within the
+# other clade.  The partitions are the most rootward such pairs no
+# bigger than 1/(4*jobs) of the whole.  Each is one task, for both
+# subtrees.  Nodes outside every partition (the residue, near the
+# roots) are left to extensional_match_map, which does them serially.
+
+# As in intension.best_candidates_in_parallel, workers are forked, so
+# they share the checklists and maps.  Returns a dict from node to
+# ((cod, relation name, reason) of its extensional match, or None;
+# log messages).
+
+_shared_maps = None             # (draft, xmrcas, particles), for workers
+
+def extensional_matches_in_partitions(B, A, draft, xmrcas, particles, jobs):
+  global _shared_maps
+  if not "fork" in multiprocessing.get_all_start_methods():
+    return {}
+  limit = (A.row_count + B.row_count) // (jobs * 4)
+  partitions = find_partitions(B, xmrcas, limit)
+  if not partitions: return {}
+  # Largest first; the many small ones near the tips go in batches
+  partitions.sort(key=lambda p: -(subtree_size(p[0]) + subtree_size(p[1])))
+  chunk = max(len(partitions) // (jobs * 16), 1)
+  known = {}
+  _shared_maps = (draft, xmrcas, particles)
+  try:
+    with multiprocessing.get_context("fork").Pool(jobs) as pool:
+      for results in pool.imap_unordered(match_partition, partitions, chunk):
+        known.update(results)
+  finally:
+    _shared_maps = None
+  dribble.log("# Extensional matches for %s nodes in %s partitions, %s jobs" %
+              (len(known), len(partitions), jobs))
+  return known
+
+def find_partitions(B, xmrcas, limit):
+  partitions = []
+  def choose(node, passed):
+    partner = xmrcas.get(node)
+    if partner == None:
+      return traverse.prune     # nothing in here has a cross-mrca
+    if (xmrcas.get(partner) == node and
+        subtree_size(node) + subtree_size(partner) <= limit):
+      partitions.append((node, partner))
+      return traverse.prune
+  traverse.walk(cl.get_roots(B), cl.get_children, pre=choose)
+  return partitions
+
+# Number of records (accepted and synonyms) in node's subtree
+
+def subtree_size(node):
+  checklist = cl.get_checklist(node)
+  row = node - checklist.first_uid
+  return checklist.sequence_ends[row] - checklist.sequence_numbers[row]
+
+# Runs in a worker process
+
+def match_partition(partition):
+  (draft, xmrcas, particles) = _shared_maps
+  results = []
+  for node in traverse.preorder(list(partition), cl.get_children):
+    if not draft.get(node):
+      dribble.captured = []
+      e = extensional_match(node, xmrcas, particles)
+      if e:
+        e = (e.cod, e.relation.name, e.reason)
+      results.append((node, (e, dribble.captured)))
+  dribble.captured = None
+  return results
+
+# ---------- Extensional match of one node
+
 # Guaranteed invertible, except for monotypic node chains
 # This code is derived from 
 #   reference-taxonomy/org/opentreeoflife/conflict/ConflictAnalysis.java
 
-def extensional_match(node, xmrcas):
+# particles is a ParticleSets (see particles.py) for the checklists.
+
+def extensional_match(node, xmrcas, particles):
   partner = xmrcas.get(node)      # node in other checklist; 'conode'
   if not partner:
     # Descendant of a particle
@@ -158,119 +263,119 @@ def extensional_match(node, xmrcas):
   else:               # must be rel.lt
     # Assume resolution (node < partner) until conflict is proven
     reason = "refinement"
-    # Look for an intersection between any partner-child and node
-    # x is in A checklist, y is in B checklist
+    # Look for a partner-child that is in conflict with node (some of
+    # its particles in node, some not, and node having some not in
+    # it); failing that, one that is disjoint from node.  Both come
+    # from the particle sets (see particles.py); the witnesses are
+    # particles, the lowest numbered of their kinds.
+    last_out = None
     for pchild in cl.get_children(partner):
-      pchild_back = xmrcas.get(pchild)
-      if pchild_back == None:
-        # pchild ! node
-        pass
-      else:
-        (d, e) = cross_compare(node, pchild, xmrcas)
+      # (None if pchild has no cross-mrca)
+      how_child = particles.relation(node, pchild)
+      if how_child == rel.conflict:
+        (d, e) = particles.witnesses(node, pchild)
         # d < node while e ! node
-        if d and e:
-          how = rel.conflict
-          reason = ("%s is in; its sibling %s is not" %
-                    (cl.get_unique(d), cl.get_unique(e)))
-          dribble.log("** %s conflicts with %s because\n"
-                      "   %s ! %s\n   (but sibling %s < %s)" %
-                      (cl.get_unique(node),
-                       cl.get_unique(partner),
-                       cl.get_unique(e),
-                       cl.get_unique(node),
-                       cl.get_unique(d),
-                       cl.get_unique(node)))
-          break
-        elif e:
-          reason = ("%s is not in it" % cl.get_unique(e))
+        how = rel.conflict
+        reason = ("%s is in; %s is not" %
+                  (cl.get_unique(d), cl.get_unique(e)))
+        dribble.log("** %s conflicts with %s because\n"
+                    "   %s ! %s\n   (but %s < %s)" %
+                    (cl.get_unique(node),
+                     cl.get_unique(partner),
+                     cl.get_unique(e),
+                     cl.get_unique(node),
+                     cl.get_unique(d),
+                     cl.get_unique(node)))
+        break
+      elif how_child == rel.disjoint:
+        last_out = pchild
+    if how != rel.conflict and last_out:
+      (_, e) = particles.witnesses(node, last_out)
+      reason = ("%s is not in it" % cl.get_unique(e))
 
   ar = art.extensional(node, partner, how, reason)
   if dribble.watch(node):
     dribble.log("# Extensional articulation %s" % art.express(ar))
   return ar
 
-# ---------- Determine disjointness across checklists
-
-# Compare node (in A) to conode (in B) according to particle sets.
-
-# Returns disjoint descendants (x, y) of conode where
-#    x <= conode ∩ node, or x = None if conode ! node
-#    y <= conode - node, or y = None if conode <= node
-
-# We're looking for two things
-#  1. whether they intersect (if so then parent conflict can be detected) -
-#      i.e. a conode descendant that *is* a node descendant.
-#  2. why they are not equal (goes to conflict diagnosis) - example of
-#      conode descendant that is *not* a node descendant.
-
-# On each recursive call, we can obtain one or the other of these, or both.
-# Or maybe none.
-
-# The recursion is over conode, searching for sibling descendants for
-# which one is in node and the other is not.
+# ---------- Cross-MRCAs
 
-def cross_compare(node, conode, xmrcas):
-  back = xmrcas.get(conode)
-  if back == None:
-    return (None, None)
-  how = cl.how_related(node, back)
-  if how == rel.eq:
-    return (conode, None)    # conode <= node
-  elif how == rel.gt:
-    return (conode, None)    # conode <= node
-  elif how == rel.disjoint:
-    return (None, conode)    # conode ! node
-  assert how == rel.lt    # node < back is inconclusive
-  x_seen = None
-  y_seen = None
-  for child in cl.get_children(conode):
-    saw = cross_compare(node, child, xmrcas)
-    if saw:
-      (x, y) = saw
-      if x and y:
-        return saw
-      elif x:
-        if y_seen:
-          return (x, y_seen)
-        else:
-          x_seen = x
-      elif y:
-        if x_seen:
-          return (x_seen, y)
-        else:
-          y_seen = y
-  return (x_seen, y_seen)
+# A node's cross-mrca is its tipward match's codomain if it's tipward,
+# otherwise the mrca of its children's cross-mrcas (forest if they're
+# in different trees).  Below tipward nodes there are none.
 
-# ---------- Cross-MRCAs
+# One pass over each checklist's rows in reverse preorder, so children
+# come before parents.  Each node passes up the least and greatest (by
+# sequence number in the other checklist) of its cross-mrca, and its
+# parent takes the common ancestor of the least and greatest it got:
+# the mrca of all of them.  Cross-mrcas are listed in postorder, as a
+# walk would find them.
 
 def analyze_cross_mrcas(A, B, tipwards):
   cross_mrcas = {}
   def half_analyze_cross_mrcas(checklist, other):
-    def subanalyze_cross_mrcas(node, other):
-      result = None
+    first = checklist.first_uid
+    count = checklist.row_count
+    flags = checklist.topology.accepted_flags
+    parents = checklist.topology.parents
+    ends = checklist.sequence_ends
+    other_first = other.first_uid
+    other_numbers = other.sequence_numbers
+    by_number = cl.rows_in_preorder(checklist)
+    # Tipward nodes, and the ends of their subtrees (nothing below)
+    skip = array.array('B', bytes(count))
+    number = 0
+    while number < count and by_number[number] >= 0:
+      row = by_number[number]
+      if first + row in tipwards:
+        for below in range(number + 1, ends[row]):
+          skip[by_number[below]] = 1
+        number = ends[row]
+      else:
+        number += 1
+    # Least and greatest cross-mrca among each node's children; 0 =
+    # none yet, forest = children in different trees
+    least = array.array('q', bytes(8 * count))
+    greatest = array.array('q', bytes(8 * count))
+    forest = array.array('B', bytes(count))
+    found = []
+    for number in range(count - 1, -1, -1):
+      row = by_number[number]
+      if row < 0 or not flags[row] or skip[row]: continue
+      node = first + row
       probe = tipwards.get(node)
       if probe:
         # Could be: = < or >
         result = probe.cod
+      elif forest[row]:
+        result = cl.forest_tnu
+      elif least[row]:
+        result = cl.mrca_of([least[row], greatest[row]])
       else:
-        children = cl.get_children(node)
-        if children:
-          m = None      # None is the identity for mrca
-          for child in children:
-            m2 = subanalyze_cross_mrcas(child, other)
-            if m2 != None:
-              m = cl.mrca(m, m2) if m != None else m2
-          if m != None:
-            result = m
+        continue
       if result:
         assert cl.get_checklist(result) != cl.get_checklist(node)
-        if dribble.watch(node):
-          dribble.log("# Cross-mrca(%s) = %s" %
-                      (cl.get_unique(node), cl.get_unique(result)))
+        found.append(node)
         cross_mrcas[node] = result
-      return result             # in B
-    for root in cl.get_roots(checklist):
-      subanalyze_cross_mrcas(root, other)
+      parent = parents[row]
+      if parent == cl.forest_tnu: continue
+      prow = parent - first
+      if result == cl.forest_tnu:
+        forest[prow] = 1
+      elif not least[prow]:
+        least[prow] = greatest[prow] = result
+      else:
+        n = other_numbers[result - other_first]
+        if n < other_numbers[least[prow] - other_first]:
+          least[prow] = result
+        elif n > other_numbers[greatest[prow] - other_first]:
+          greatest[prow] = result
+    for node in cl.in_postorder(checklist, found):
+      result = cross_mrcas.pop(node)
+      cross_mrcas[node] = result
+      if dribble.watch(node):
+        dribble.log("# Cross-mrca(%s) = %s" %
+                    (cl.get_unique(node), cl.get_unique(result)))
   half_analyze_cross_mrcas(A, B)
   half_analyze_cross_mrcas(B, A)
 
@@ -293,31 +398,35 @@ def analyze_cross_mrcas(A, B, tipwards):
 
 # This function returns a partial map from nodes to articulations.
 
-# Filter out internal nodes (those having a matched descendant)
+# Filter out internal nodes (those having a matched descendant).  A
+# node's descendants are the nodes whose sequence numbers are in its
+# subtree's range, so a matched node is tipward unless the next matched
+# node in preorder falls in that range.  Tipward matches are listed in
+# postorder, as a walk would find them.
 
 def tipward(amap, A, B):
-  tw = {}
-  def filter(node):
-    debug = dribble.watch(node)
-    found_match = None
-    for child in cl.get_children(node):
-      ar = filter(child)
-      if ar:
-        found_match = ar
-    if found_match:    # Some descendant is a particle
-      if debug: dribble.log("# %s: descendant matches, not keeping: %s" %
-                            (cl.get_unique(node), art.express(found_match)))
-      return found_match
-    elif node in amap:
+  tw = art.Alignment()
+  for checklist in (A, B):
+    first = checklist.first_uid
+    numbers = checklist.sequence_numbers
+    ends = checklist.sequence_ends
+    matched = sorted((numbers[node - first], node)
+                     for node in amap
+                     if first <= node < first + checklist.row_count and
+                        numbers[node - first] >= 0)
+    kept = []
+    for i in range(len(matched)):
+      (_, node) = matched[i]
+      if i + 1 < len(matched) and matched[i + 1][0] < ends[node - first]:
+        if dribble.watch(node):
+          dribble.log("# %s: descendant matches, not keeping: %s" %
+                      (cl.get_unique(node), art.express(amap[node])))
+      else:
+        kept.append(node)
+    for node in cl.in_postorder(checklist, kept):
       ar = amap[node]
       tw[ar.dom] = ar
-      if debug: dribble.log("# %s is a tipward match, keeping: %s" %
-                            (cl.get_unique(node), art.express(ar)))
-      return ar
-    else:
-      if debug: dribble.log("# %s is unmatched" % cl.get_unique(node))
-      return None
-  for root in cl.get_roots(A): filter(root)
-  for root in cl.get_roots(B): filter(root)
+      if dribble.watch(node):
+        dribble.log("# %s is a tipward match, keeping: %s" %
+                    (cl.get_unique(node), art.express(ar)))
   return tw
-
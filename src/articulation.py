@@ -6,7 +6,9 @@
 #   Composition
 #   Disjunction ??
 
-import collections
+import array, builtins
+import collections.abc
+import table
 import relation as rel
 import checklist as cl
 import property
@@ -18,10 +20,136 @@ import dribble
 # reason and factors are mutually exclusive.  reason is only for
 # non-composed articulations.
 
-Articulation = \
-  collections.namedtuple('Articulation',
-                         ['dom', 'cod', 'relation', 'factors',
-                          'reason', 'revreason', 'diff'])
+# The articulations made during a table session (see table.session)
+# are kept in one table, column by column (as checklists are; see
+# table.py), which goes when the session's checklists do.  An
+# Articulation is a view of one row of it.  Relations, reasons and
+# factor lists are stored as small integers:
+#   relations   - index into relation_list
+#   reasons     - index into strings (0 = None), also revreasons
+#   chains      - factor chain (0 = no factors; see below)
+# The diff isn't stored; it's compared on first use (see
+# changes.differences, which remembers it).
+
+# A factor chain is a cons list in the chain table: chain c is the
+# articulation in row heads[c], followed by chain tails[c].  Composing
+# p with q conses p's factors onto q's chain, which is shared, not
+# copied.
+
+class ArticulationTable:
+  def __init__(self):
+    for name in ["doms", "cods", "reasons", "revreasons", "chains"]:
+      setattr(self, name, array.array('q'))
+    self.relations = array.array('B')
+    self.heads = array.array('q', [-1])
+    self.tails = array.array('q', [0])
+    self.strings = [None]
+    self.string_ids = {None: 0}
+    self.relation_list = []
+    self.relation_codes = {}
+
+  def __len__(self):
+    return len(self.doms)
+
+  def add(self, dom, cod, re, reason, revreason, chain):
+    row = len(self.doms)
+    self.doms.append(dom)
+    self.cods.append(cod)
+    self.relations.append(self.relation_code(re))
+    self.reasons.append(self.string_id(reason))
+    self.revreasons.append(self.string_id(revreason))
+    self.chains.append(chain)
+    return row
+
+  def string_id(self, s):
+    i = self.string_ids.get(s)
+    if i == None:
+      i = len(self.strings)
+      self.strings.append(s)
+      self.string_ids[s] = i
+    return i
+
+  def relation_code(self, re):
+    code = self.relation_codes.get(re)
+    if code == None:
+      code = len(self.relation_list)
+      self.relation_list.append(re)
+      self.relation_codes[re] = code
+    return code
+
+  # Chain of the given rows, in order, ahead of chain 'tail'
+
+  def chain(self, rows, tail = 0):
+    for row in reversed(rows):
+      self.heads.append(row)
+      self.tails.append(tail)
+      tail = len(self.heads) - 1
+    return tail
+
+  def chain_rows(self, chain):
+    rows = []
+    while chain:
+      rows.append(self.heads[chain])
+      chain = self.tails[chain]
+    return rows
+
+# The current session's table
+
+def articulation_table():
+  registry = table.current_registry()
+  if registry.articulations == None:
+    registry.articulations = ArticulationTable()
+  return registry.articulations
+
+def _column(name):
+  return builtins.property(lambda ar: getattr(ar.table, name)[ar.row])
+
+def _string(name):
+  return builtins.property(
+    lambda ar: ar.table.strings[getattr(ar.table, name)[ar.row]])
+
+class Articulation:
+  __slots__ = ("table", "row")
+
+  def __init__(self, table, row):
+    self.table = table
+    self.row = row
+
+  dom = _column("doms")
+  cod = _column("cods")
+  reason = _string("reasons")
+  revreason = _string("revreasons")
+
+  @builtins.property
+  def relation(self):
+    return self.table.relation_list[self.table.relations[self.row]]
+
+  @builtins.property
+  def factors(self):
+    chain = self.table.chains[self.row]
+    if not chain: return None
+    return [Articulation(self.table, row)
+            for row in self.table.chain_rows(chain)]
+
+  @builtins.property
+  def diff(self):
+    dom = self.dom
+    cod = self.cod
+    if cl.is_accepted(dom) and cl.is_accepted(cod):
+      return changes.differences(dom, cod)
+    return changes.all_diffs
+
+  def __eq__(self, other):
+    return (isinstance(other, Articulation) and
+            other.table is self.table and other.row == self.row)
+
+  def __hash__(self):
+    return hash(self.row)
+
+  def __repr__(self):
+    return "Articulation(%s)" % express(self)
+
+# factors, if given, is a list of Articulations or a chain
 
 def _articulation(dom, cod, re,
                   reason = None, revreason = None, factors = None):
@@ -29,13 +157,47 @@ def _articulation(dom, cod, re,
   assert cod > 0
   assert re
   assert re.name
-  dif = changes.all_diffs
-  if cl.is_accepted(dom) and cl.is_accepted(cod):
-    dif = changes.differences(dom, cod)
   assert reason or factors
   if reason and revreason == None: revreason = reason + " of"
-  ar = Articulation(dom, cod, re, factors, reason, revreason, dif)
-  return ar
+  arts = articulation_table()
+  if isinstance(factors, list):
+    assert all(f.table is arts for f in factors)
+    factors = arts.chain([f.row for f in factors])
+  return Articulation(arts, arts.add(dom, cod, re, reason, revreason,
+                                     factors or 0))
+
+# An alignment (or any map from nodes to articulations): the
+# articulations' rows, by node, all in one articulation table.  Reads
+# as a dict of Articulations.
+
+class Alignment(collections.abc.MutableMapping):
+  def __init__(self):
+    self.table = None
+    self.rows = {}
+
+  def __getitem__(self, node):
+    return Articulation(self.table, self.rows[node])
+
+  def __setitem__(self, node, ar):
+    if self.table == None: self.table = ar.table
+    assert ar.table is self.table
+    self.rows[node] = ar.row
+
+  def __delitem__(self, node):
+    del self.rows[node]
+
+  def __contains__(self, node):
+    return node in self.rows
+
+  def __iter__(self):
+    return iter(self.rows)
+
+  def __len__(self):
+    return len(self.rows)
+
+  def get(self, node, default = None):
+    row = self.rows.get(node)
+    return default if row == None else Articulation(self.table, row)
 
 def express(ar):
   if ar == None:
@@ -56,7 +218,21 @@ def compose(p, q):
                        q.cod,
                        rel.compose(p.relation, q.relation),
                        reason = None,
-                       factors = (p.factors or [p]) + (q.factors or [q]))
+                       factors = compose_chains(p, q))
+
+# p's factors, then q's (sharing q's chain)
+
+def compose_chains(p, q):
+  arts = p.table
+  assert q.table is arts
+  return arts.chain(factor_rows(p), arts.chains[q.row] or arts.chain([q.row]))
+
+def factor_rows(ar):
+  chain = ar.table.chains[ar.row]
+  return ar.table.chain_rows(chain) if chain else [ar.row]
+
+def factor_count(ar):
+  return len(factor_rows(ar))
 
 def reason(p):
   if p.factors:
@@ -84,8 +260,10 @@ def get_comment(ar):
   return ar.relation.name
 
 def reverse(ar):
-  if ar.factors:
-    f = list(reversed(ar.factors))
+  arts = ar.table
+  chain = arts.chains[ar.row]
+  if chain:
+    f = arts.chain(list(reversed(arts.chain_rows(chain))))
   else:
     f = None
   return _articulation(ar.cod, ar.dom, rel.reverse(ar.relation),
@@ -104,7 +282,8 @@ def inverses(ar1, ar2):
 # Foo.  Phase out
 
 def set_relation(ar, re):      # re = rel.eq
-  return _articulation(ar.dom, ar.cod, re, ar.reason, ar.revreason, ar.factors)
+  return _articulation(ar.dom, ar.cod, re, ar.reason, ar.revreason,
+                       ar.table.chains[ar.row])
 
 def change_relation(ar, re, reason, revreason = reason):  # re = rel.gt
   assert reason
@@ -174,18 +353,22 @@ def bridge(dom, cod, re, reason):
   return _articulation(dom, cod, re, reason=reason)
 
 # Intensional matches by name (no synonym following)
-# This ought to be cached I think?
+# For all of a checklist's nodes at once, see candidates.py
+
+# Properties by which nodes match, in order of preference
+
+match_properties = [cl.ncbi_id,
+                    cl.eol_page_id,
+                    cl.scientific_name,
+                    cl.canonical_name,
+                    cl.gbif_id]
 
 def direct_matches(node, other):
   assert node > 0
   assert cl.get_checklist(node) != other
   seen = []
   arts = []
-  for prop in [cl.ncbi_id,
-               cl.eol_page_id,
-               cl.scientific_name,
-               cl.canonical_name,
-               cl.gbif_id]:
+  for prop in match_properties:
     val = cl.get_value(node, prop)
     if val != None:
       more = cl.get_nodes_with_value(other, prop, val)
@@ -239,7 +422,7 @@ def badness(ar):
          # Additions don't matter
          change,
          # Using synonym is bad, using two is worse
-         len(ar.factors) if ar.factors else 1,
+         factor_count(ar),
          drop,
          # Added fields are benign
          # Dropped fields are so-so
@@ -249,6 +432,34 @@ def badness(ar):
 def sort_matches(arts):
   return sorted(arts, key=badness)
 
+# The same order as badness, packed into one integer, for scoring many
+# candidates at once (see intension.best_candidates).  Fields, most
+# significant first: relation, change mask, factor count, drop mask,
+# mutex.  Only for articulations between accepted nodes, whose masks
+# are real ones.
+
+mask_bits = property.number_of_properties
+factor_bits = 16
+mutex_bits = 32
+
+relation_ranks = \
+  {re: i for (i, re) in enumerate(sorted(set(rel.relations_by_name.values()),
+                                         key=rel.sort_key))}
+
+def pack_badness(relation, diff, factor_count, mutex):
+  (drop, change, add) = diff
+  assert change >= 0 and drop >= 0
+  key = relation_ranks[relation]
+  key = (key << mask_bits) | change
+  key = (key << factor_bits) | factor_count
+  key = (key << mask_bits) | drop
+  return (key << mutex_bits) | mutex
+
+def packed_badness(ar):
+  return pack_badness(ar.relation, ar.diff,
+                      factor_count(ar),
+                      cl.get_mutex(ar.cod))
+
 # -----
 
 def proclaim(draft, ar):
@@ -0,0 +1,250 @@
+# Binary checklist cache (.cldx files)
+
+# After a checklist has been read from a CSV/TSV file, its columns,
+# indexes, and any other per-record arrays the caller wants kept
+# (sequence numbers, ...) are written next to the source as
+# <source>.cldx (beside the archive, if the source is in a zip file).
+# A later read of the same unchanged source maps that
+# file into memory instead of parsing again.  Columns are used in
+# place through memoryviews; indexes are unpickled only when first
+# asked for.
+
+# Layout:
+#   magic (8 bytes), header length (8 bytes), header (marshal),
+#   then 8-byte aligned sections of raw array data / marshal data.
+# The header records the source's size, mtime and content hash.  If
+# the size and mtime match, the cache is used.  If only the size
+# matches (file copied or touched), the content hash decides, and if
+# it matches the header takes the new mtime, so the source isn't
+# hashed again next time.
+
+import os, sys, mmap, marshal, hashlib, time
+
+import property
+import column
+import table
+import dwca
+import dribble
+
+magic = b"CLDX\x00\x00\x00\x01"
+
+# A source in a zip file is identified by the zip file itself
+
+def cache_path(source):
+  return dwca.split_archive(source)[0] + ".cldx"
+
+def content_hash(path):
+  h = hashlib.blake2b(digest_size=16)
+  with open(dwca.split_archive(path)[0], "rb") as infile:
+    while True:
+      block = infile.read(1 << 20)
+      if not block: break
+      h.update(block)
+  return h.hexdigest()
+
+def source_key(path):
+  st = os.stat(dwca.split_archive(path)[0])
+  return {"size": st.st_size, "mtime": st.st_mtime_ns}
+
+# ---------- Writing
+
+class Writer:
+  def __init__(self):
+    self.chunks = []
+    self.position = 0
+
+  # Returns (offset, length) relative to the start of the data area
+
+  def add(self, data):
+    data = bytes(data)
+    offset = self.position
+    self.chunks.append(data)
+    pad = -len(data) % 8
+    if pad: self.chunks.append(b"\0" * pad)
+    self.position += len(data) + pad
+    return (offset, len(data))
+
+def column_description(col, writer):
+  if col.kind == "text":
+    return {"kind": "text",
+            "buffer": writer.add(col.buffer),
+            "offsets": writer.add(col.offsets)}
+  elif col.kind == "int":
+    return {"kind": "int", "numbers": writer.add(col.numbers)}
+  else:
+    return {"kind": "code",
+            "codes": writer.add(col.codes),
+            "dictionary": col.dictionary}
+
+# 'key' identifies the parameters the table was read with (anything
+# besides the file contents that affects what's in the table).
+# 'arrays' maps names to arrays of per-row data.
+
+def save(tab, source, key, arrays = {}):
+  start = time.perf_counter()
+  writer = Writer()
+  columns = {}
+  for (_, uid) in tab.stored:
+    prop = property.properties_by_specificity[uid]
+    columns[prop.pet_name] = column_description(tab.columns[uid], writer)
+  indexes = {}
+  for (prop, idx) in zip(property.properties_by_specificity, tab.indexes):
+    if idx != None:
+      indexes[prop.pet_name] = writer.add(marshal.dumps(idx.rows))
+  extras = {}
+  for (name, arr) in arrays.items():
+    extras[name] = (arr.typecode, writer.add(arr))
+  header = {"source": dict(source_key(source), hash=content_hash(source)),
+            "key": key,
+            "byteorder": sys.byteorder,
+            "labels": tab.header,
+            "row_count": tab.row_count,
+            "columns": columns,
+            "indexes": indexes,
+            "arrays": extras}
+  head = marshal.dumps(header)
+  head += b"\0" * (-len(head) % 8)
+  path = cache_path(source)
+  temp = path + ".new"
+  try:
+    with open(temp, "wb") as outfile:
+      outfile.write(magic)
+      outfile.write(len(head).to_bytes(8, "little"))
+      outfile.write(head)
+      for chunk in writer.chunks:
+        outfile.write(chunk)
+    os.replace(temp, path)
+  except OSError as e:
+    dribble.log("# Could not write checklist cache %s: %s" % (path, e))
+    return False
+  dribble.log("# Wrote checklist cache %s in %.2fs" %
+              (path, time.perf_counter() - start))
+  return True
+
+# ---------- Reading
+
+# Returns (header, offset of data area)
+
+def read_header(path):
+  with open(path, "rb") as infile:
+    if infile.read(8) != magic: return (None, None)
+    length = int.from_bytes(infile.read(8), "little")
+    return (marshal.loads(infile.read(length)), 16 + length)
+
+def is_current(header, source, key):
+  if header == None: return False
+  if header["key"] != key or header["byteorder"] != sys.byteorder:
+    return False
+  have = header["source"]
+  now = source_key(source)
+  if have["size"] != now["size"]: return False
+  if have["mtime"] == now["mtime"]: return True
+  return have["hash"] == content_hash(source)
+
+# Record the source's current mtime in the header of the cache at path,
+# whose data area starts at base.  The header is rewritten in place if
+# it still fits (marshal ignores the padding after it); otherwise the
+# whole file is rewritten.
+
+def refresh_header(path, header, base, source):
+  header["source"] = dict(header["source"], mtime=source_key(source)["mtime"])
+  head = marshal.dumps(header)
+  head += b"\0" * (-len(head) % 8)
+  try:
+    if len(head) <= base - 16:
+      with open(path, "r+b") as outfile:
+        outfile.seek(16)
+        outfile.write(head + b"\0" * (base - 16 - len(head)))
+    else:
+      temp = path + ".new"
+      with open(path, "rb") as infile, open(temp, "wb") as outfile:
+        infile.seek(base)
+        outfile.write(magic)
+        outfile.write(len(head).to_bytes(8, "little"))
+        outfile.write(head)
+        while True:
+          block = infile.read(1 << 20)
+          if not block: break
+          outfile.write(block)
+      os.replace(temp, path)
+      base = 16 + len(head)
+  except OSError as e:
+    dribble.log("# Could not update checklist cache %s: %s" % (path, e))
+  return base
+
+def column_from_description(desc, data):
+  def part(name, typecode = None):
+    (offset, length) = desc[name]
+    view = data[offset : offset + length]
+    return view.cast(typecode) if typecode else view
+  kind = desc["kind"]
+  col = column.new_column(kind)
+  if kind == "text":
+    col.buffer = part("buffer")
+    col.offsets = part("offsets", 'q')
+  elif kind == "int":
+    col.numbers = part("numbers", 'q')
+  else:
+    col.codes = part("codes", 'H')
+    col.dictionary = desc["dictionary"]
+    col.code_index = {value or '': code
+                      for (code, value) in enumerate(col.dictionary)}
+  return col
+
+# Populate tab from the cache for source, if there is a current one.
+# Returns a dict of the extra arrays that were saved with it, or None
+# if the cache can't be used.
+
+def load(tab, source, key):
+  path = cache_path(source)
+  if not os.path.exists(path): return None
+  start = time.perf_counter()
+  try:
+    (header, base) = read_header(path)
+    if not is_current(header, source, key):
+      dribble.log("# Checklist cache %s is out of date" % path)
+      return None
+    if header["source"]["mtime"] != source_key(source)["mtime"]:
+      base = refresh_header(path, header, base, source)
+    with open(path, "rb") as infile:
+      mapping = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+  except (OSError, ValueError, EOFError) as e:
+    dribble.log("# Could not read checklist cache %s: %s" % (path, e))
+    return None
+
+  # Every column the table will keep must be there; tab is left alone
+  # (and the mapping closed) if one isn't
+  for label in header["labels"]:
+    prop = property.by_name(label)
+    if prop and (tab.projection == None or prop.uid in tab.projection):
+      if not prop.pet_name in header["columns"]:
+        dribble.log("# Checklist cache %s lacks column %s" %
+                    (path, prop.pet_name))
+        mapping.close()
+        return None
+  data = memoryview(mapping)[base:]
+
+  tab.process_header(header["labels"])
+  for (_, uid) in tab.stored:
+    prop = property.properties_by_specificity[uid]
+    tab.columns[uid] = column_from_description(header["columns"][prop.pet_name],
+                                               data)
+  tab.row_count = header["row_count"]
+  tab.mapping = mapping
+
+  # Indexes are unmarshaled on first use
+  for (pet_name, (offset, length)) in header["indexes"].items():
+    def load_index(offset = offset, length = length):
+      return marshal.loads(data[offset : offset + length])
+    prop = property.by_name(pet_name)
+    if prop and tab.columns[prop.uid] != None:
+      tab.index_loaders[prop.uid] = load_index
+
+  table._register(tab)
+
+  arrays = {}
+  for (name, (typecode, (offset, length))) in header["arrays"].items():
+    arrays[name] = data[offset : offset + length].cast(typecode)
+  dribble.log("# Loaded %s records from checklist cache %s in %.2fs" %
+              (tab.row_count, path, time.perf_counter() - start))
+  return arrays
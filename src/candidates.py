@@ -0,0 +1,135 @@
+# Candidates: all the intensional matches between two checklists, at once
+
+# Instead of probing the other checklist's indexes one node and one
+# property at a time (articulation.direct_matches), each matching
+# property's index in one checklist is joined with the same property's
+# index in the other.  The hits are then gathered, per accepted node,
+# into a table of candidate matches for intension.py to choose among.
+
+# A candidate is a row of the table:
+#   doms          - accepted node in the 'here' checklist
+#   cods          - accepted node in the 'there' checklist
+#   props         - uid of the property whose values matched
+#   dom_synonyms  - synonym of dom whose value matched, or 0 if dom's did
+#   cod_synonyms  - synonym of cod whose value matched, or 0 if cod's did
+# Rows with the same dom are consecutive.  For each dom, the rows come
+# in this order: the dom's own matches, then those of each of its
+# synonyms; for each of these, by property (in the order of
+# articulation.match_properties), then by position in the other
+# checklist.
+
+import array
+
+import checklist as cl
+import articulation as art
+import property
+import dribble
+
+columns = ["doms", "cods", "props", "dom_synonyms", "cod_synonyms"]
+
+class Candidates:
+  def __init__(self):
+    for name in columns:
+      setattr(self, name, array.array('q'))
+
+  def __len__(self):
+    return len(self.doms)
+
+  # (dom, start, end) for each dom; its rows are start up to end
+
+  def groups(self):
+    doms = self.doms
+    count = len(doms)
+    start = 0
+    while start < count:
+      dom = doms[start]
+      end = start + 1
+      while end < count and doms[end] == dom:
+        end += 1
+      yield (dom, start, end)
+      start = end
+
+  def get_property(self, i):
+    return property.by_specificity(self.props[i])
+
+# For every record of 'here', the records of 'there' that have the same
+# value for one of props, as (starts, hits, hit_props): the hits for row
+# r are hits[starts[r] : starts[r+1]], and hit_props says which
+# property each hit is by.  As with direct_matches, a record that
+# matches by more than one property is listed only once, for the first.
+
+def direct_hits(here, there, props):
+  found = {}                    # row in here -> [(uid in there, prop uid)]
+  for prop in props:
+    if here.columns[prop.uid] == None or there.columns[prop.uid] == None:
+      continue
+    source = here.get_index(prop)
+    target = there.get_index(prop)
+    targets = target.rows
+    if (source.column.kind == "int") == (target.column.kind == "int"):
+      sources = source.rows
+    else:
+      # Keys are represented differently; translate ours into theirs
+      decode = source.column.decode_key
+      key_of = target.column.key_of
+      sources = {}
+      for (key, rows) in source.rows.items():
+        sources[key_of(decode(key))] = rows
+      sources.pop(None, None)
+    tbase = target.base
+    for key in sources.keys() & targets.keys():
+      rows = sources[key]
+      hits = targets[key]
+      hits = ([tbase + hits] if type(hits) is int
+              else [tbase + row for row in hits])
+      for row in ([rows] if type(rows) is int else rows):
+        have = found.get(row)
+        if have == None:
+          found[row] = [(hit, prop.uid) for hit in hits]
+        else:
+          seen = [hit for (hit, _) in have]
+          have.extend([(hit, prop.uid) for hit in hits if not hit in seen])
+  starts = array.array('q', [0])
+  all_hits = array.array('q')
+  hit_props = array.array('q')
+  for row in range(here.row_count):
+    have = found.get(row)
+    if have:
+      for (hit, prop_uid) in have:
+        all_hits.append(hit)
+        hit_props.append(prop_uid)
+    starts.append(len(all_hits))
+  return (starts, all_hits, hit_props)
+
+# The candidate matches of every accepted node of 'here' in 'there'.
+# synonyms(node) gives the synonyms of an accepted node whose matches
+# also count as the node's.
+
+def candidate_table(here, there, synonyms):
+  table = Candidates()
+  (starts, hits, hit_props) = direct_hits(here, there, art.match_properties)
+  first = here.first_uid
+  flags = here.topology.accepted_flags
+  tfirst = there.first_uid
+  taccepteds = there.topology.accepteds
+  (doms, cods, props, dom_synonyms, cod_synonyms) = \
+    [getattr(table, name) for name in columns]
+  def add(dom, source):
+    row = source - first
+    for i in range(starts[row], starts[row + 1]):
+      hit = hits[i]
+      accepted = taccepteds[hit - tfirst]
+      doms.append(dom)
+      cods.append(accepted or hit)
+      props.append(hit_props[i])
+      dom_synonyms.append(0 if source == dom else source)
+      cod_synonyms.append(hit if accepted else 0)
+  for row in range(here.row_count):
+    if flags[row]:
+      node = first + row
+      add(node, node)
+      for syn in synonyms(node):
+        add(node, syn)
+  dribble.log("# %s intensional match candidates for %s nodes of %s" %
+              (len(table), len(set(table.doms)), here.prefix))
+  return table
@@ -1,7 +1,9 @@
 debug = False
 
+import sys, array
 import table
 import property
+import column
 import checklist as cl
 
 # Difference report, comparing two nodes.
@@ -31,8 +33,22 @@ parentNameUsageID = property.by_name("parentNameUsageID")
 
 # TBD: filter out taxonID if idspaces are different
 
+# Comparisons are made on first use and remembered, per pair and set
+# of properties compared, with uid1's checklist (see cl.recall), so no
+# pair is compared twice.  props isn't passed on: the comparison is
+# always over uid2's table's properties, so every caller shares the
+# one entry for the pair.
+
 def differences(uid1, uid2, props = None):  # mask
-  (add, change, drop) = differences_in_record(uid1, uid2, props = None)
+  return compare(uid1, uid2, None)
+
+def compare(uid1, uid2, props):
+  key = (uid1, uid2, None if props == None else frozenset(props))
+  return cl.recall(uid1, "comparison", key,
+                   lambda: compute_differences(uid1, uid2, props))
+
+def compute_differences(uid1, uid2, props):
+  (add, change, drop) = differences_in_record(uid1, uid2, props)
   if len(cl.get_children(uid1)) != len(cl.get_children(uid2)):
     change |= 1 << number_of_children.specificity
   return (add, change, drop)
@@ -57,6 +73,128 @@ def differences_in_record(uid1, uid2, props = None):  # mask
   # TBD: compare parents ??
   return (drop, change, add)
 
+# ---------- Many pairs at once
+
+# The same comparison as differences, for many pairs: uid1s[i] with
+# uid2s[i].  The uid1s must be from one table and the uid2s from one
+# table.  Rather than fetching two values per pair per property, each
+# property's two columns are compared as wholes, over the pairs' rows:
+# as numbers for identifier columns, as dictionary codes (translated
+# from one dictionary to the other) for low-cardinality columns, and as
+# strings otherwise.  Fields of a lazily read table (see
+# Table.populate_lazily) are split out of each record's line once, for
+# all properties together, and kept in split (uid -> values) for later
+# calls to share.  Children are counted from the topology.  Returns
+# three arrays (drops, changes, adds).
+
+def differences_of_pairs(uid1s, uid2s, split = None):
+  count = len(uid1s)
+  assert len(uid2s) == count
+  masks = [array.array('q', bytes(8 * count)) for _ in range(3)]
+  if count == 0: return masks
+  (drops, changes, adds) = masks
+  t1 = table.get_table(uid1s[0])
+  t2 = table.get_table(uid2s[0])
+  rows1 = array.array('q', [uid - t1.first_uid for uid in uid1s])
+  rows2 = array.array('q', [uid - t2.first_uid for uid in uid2s])
+  assert min(rows1) >= 0 and max(rows1) < t1.row_count
+  assert min(rows2) >= 0 and max(rows2) < t2.row_count
+  if split == None: split = {}
+  lazy1 = lazy_values(t1, rows1, split)
+  lazy2 = lazy_values(t2, rows2, split)
+  for prop in t2.properties:
+    if prop and prop != taxonID and prop != parentNameUsageID:
+      bit = 1 << prop.specificity
+      (keys1, keys2, missing) = \
+        column_keys(t1.columns[prop.uid], t2.columns[prop.uid],
+                    rows1, rows2, lazy1, lazy2)
+      for (i, k1, k2) in zip(range(count), keys1, keys2):
+        if k1 != k2:
+          if k1 == missing:
+            adds[i] |= bit
+          elif k2 == missing:
+            drops[i] |= bit
+          else:
+            changes[i] |= bit
+  bit = 1 << number_of_children.specificity
+  counts1 = child_counts(t1, rows1)
+  counts2 = child_counts(t2, rows2)
+  for (i, n1, n2) in zip(range(count), counts1, counts2):
+    if n1 != n2: changes[i] |= bit
+  return masks
+
+# Comparable keys for two columns' values at the given rows, and the
+# key that both use for a missing value.  lazy1 and lazy2 are the
+# tables' lazy_values.
+
+def column_keys(col1, col2, rows1, rows2, lazy1, lazy2):
+  if col1 == None or col2 == None:
+    return (values_at(col1, rows1, lazy1), values_at(col2, rows2, lazy2),
+            None)
+  if col1.kind == "int" and col2.kind == "int":
+    (numbers1, numbers2) = (col1.numbers, col2.numbers)
+    return ([numbers1[row] for row in rows1],
+            [numbers2[row] for row in rows2],
+            column.missing_int)
+  if col1.kind == "code" and col2.kind == "code":
+    # col1's codes in col2's dictionary; -1 if it hasn't the value.
+    # (Made from the dictionary, since a column restored from a
+    # checklist cache has only that.)
+    index2 = {value or '': code for (code, value) in enumerate(col2.dictionary)}
+    translate = [index2.get(value or '', -1) for value in col1.dictionary]
+    (codes1, codes2) = (col1.codes, col2.codes)
+    return ([translate[codes1[row]] for row in rows1],
+            [codes2[row] for row in rows2],
+            0)
+  return (values_at(col1, rows1, lazy1), values_at(col2, rows2, lazy2),
+          None)
+
+def values_at(col, rows, lazy):
+  if col == None: return [None] * len(rows)
+  if col.kind == "lazy": return lazy[col.position]
+  return [col.get(row) for row in rows]
+
+# The values at rows of all of a table's lazy columns, by field
+# position, splitting each row's line only if it isn't in split yet
+
+def lazy_values(t, rows, split):
+  lazy = [col for col in t.columns if col != None and col.kind == "lazy"]
+  if not lazy: return {}
+  values = []
+  for row in rows:
+    uid = t.first_uid + row
+    if not uid in split:
+      fields = lazy[0].lines.get_fields(row)
+      split[uid] = [col.value_in(fields) for col in lazy]
+    values.append(split[uid])
+  return {col.position: [v[i] for v in values]
+          for (i, col) in enumerate(lazy)}
+
+def child_counts(checklist, rows):
+  starts = checklist.topology.child_starts
+  return [starts[row + 1] - starts[row] for row in rows]
+
+# Compare many pairs at once and remember the results, for differences
+# to find.  Pairs already compared are skipped.  The pairs may go
+# either way between tables; each way is compared as one batch, and a
+# lazily read record is split once for all of them.
+
+def remember_differences(uid1s, uid2s):
+  batches = {}
+  for (uid1, uid2) in zip(uid1s, uid2s):
+    if not (uid1, uid2, None) in cl.get_memo(uid1, "comparison").values:
+      key = (table.get_table(uid1).first_uid, table.get_table(uid2).first_uid)
+      batches.setdefault(key, []).append((uid1, uid2))
+  split = {}
+  for pairs in batches.values():
+    uid1s = [uid1 for (uid1, _) in pairs]
+    uid2s = [uid2 for (_, uid2) in pairs]
+    (drops, changes, adds) = differences_of_pairs(uid1s, uid2s, split)
+    for (uid1, uid2, drop, change, add) in zip(uid1s, uid2s,
+                                               drops, changes, adds):
+      cl.remember(uid1, "comparison", (uid1, uid2, None),
+                  (drop, change, add))
+
 number_of_children = property.by_name("number_of_children")
 number_of_synonyms = property.by_name("number_of_synonyms")
 
@@ -79,3 +217,29 @@ def unpack1(mask):
     if (mask & (1 << spec)) != 0:
       props.append(prop)
   return props
+
+# Test: the column-by-column comparison agrees with the one-pair-at-a-
+# time comparison, for a checklist read from its file and the same
+# checklist loaded from the cache that the first read wrote
+
+def self_test(path = "work/ncbi/2020-01-01/primates.csv"):
+  with table.session():
+    A = cl.read_checklist(path, "A.", "name")
+    B = cl.read_checklist(path, "B.", "name")
+    assert B.mapping != None    # loaded from the cache
+    uid1s = list(A.record_uids) + list(A.record_uids)
+    uid2s = list(B.record_uids) + list(reversed(B.record_uids))
+    (drops, changes, adds) = differences_of_pairs(uid1s, uid2s)
+    wrong = 0
+    for i in range(len(uid1s)):
+      if ((drops[i], changes[i], adds[i]) !=
+          compute_differences(uid1s[i], uid2s[i], None)):
+        wrong += 1
+    print ("Pairs compared:", len(uid1s))
+    print ("Identical records found different:",
+           sum(1 for i in range(A.row_count) if changes[i] or drops[i] or adds[i]))
+    print ("Disagreements:", wrong)
+    assert wrong == 0
+
+if __name__ == '__main__':
+  self_test(*sys.argv[1:])
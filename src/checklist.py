@@ -1,12 +1,16 @@
 debug = False
 
-import os, csv
+import os, csv, array
 
 import relation as rel
 import rank
 import chaitin
 import property
 import table
+import cache
+import dwca
+import topology
+import traverse
 import dribble
 
 # ---------- Fields (columns, properties) in taxon table
@@ -30,11 +34,33 @@ ncbi_id      = field("ncbi_id")
 gbif_id      = field("gbif_id")
 eol_page_id  = field("EOLid")
 
+# Fields used for lookups and joins.  These are indexed while the
+# checklist is read.
+
+indexed_fields = [taxon_id, parent_taxon_id, accepted_taxon_id,
+                  canonical_name, scientific_name,
+                  ncbi_id, eol_page_id, gbif_id]
+
+# Fields needed for almost every record: the hierarchy, the names and
+# identifiers that matching joins on (indexed_fields), and the rank
+# (for mutexes).  When reading lazily, these are the only ones parsed
+# up front; any other field of a record is split out of its line only
+# if asked for.
+
+key_fields = indexed_fields + [taxon_rank]
+
+# Fields that alignment and reporting can't do without.  Other
+# properties matter only to record comparison (changes.py), which
+# compares whatever columns a checklist has.
+
+required_fields = indexed_fields + [taxon_rank, taxonomic_status,
+                                    nomenclatural_status]
+
 # ---------- Taxon registry and taxa
 
 forest_tnu = 0
 
-# Get the value of a field of a TNU record (via global registry)
+# Get the value of a field of a TNU record (via current registry)
 
 def get_value(uid, field):
   assert field
@@ -56,7 +82,27 @@ class Checklist(table.Table):
     assert prefix
     self.prefix = prefix
     self.name = name    # not used?
-    self.sequence_numbers = {}
+    self.sequence_numbers = None    # array, by row
+    self.sequence_ends = None       # array, by row; see is_ancestor
+    self.jumps = None               # array, by row; see common_ancestor
+    self.mutexes = None             # array, by row; see assign_mutexes
+    self.containers = None          # array, by row; see is_container
+    self.topology = None            # see topology.py
+    self.validation = None          # [accepted, synonyms]; see validate
+    self.unique_names = None        # list, by row; see get_unique
+    self.memos = None               # see recall
+
+  def release(self):
+    super().release()
+    self.sequence_numbers = None
+    self.sequence_ends = None
+    self.jumps = None
+    self.mutexes = None
+    self.containers = None
+    self.topology = None
+    self.validation = None
+    self.unique_names = None
+    self.memos = None
 
   def get_all_nodes(self):
     return self.record_uids
@@ -64,60 +110,167 @@ class Checklist(table.Table):
   def tnu_count(self):
     return len(self.record_uids)
 
+  # Preorder.  The records in the subtree rooted at a record get
+  # sequence numbers from the record's own up to (not including) its
+  # sequence end.
+  # Jump pointers (for common_ancestor) are set on the way down: each
+  # accepted node's jump is an ancestor, chosen from its parent's jumps
+  # so that any ancestor can be reached in O(log depth) jumps and
+  # parent steps (Myers' skew-binary scheme).
+
   def assign_sequence_numbers(self):
-    n = len(self.sequence_numbers)    # dict
-    def process(tnu, n):
+    self.sequence_numbers = array.array('q', [-1]) * self.row_count
+    self.sequence_ends = array.array('q', [-1]) * self.row_count
+    self.jumps = array.array('q', [forest_tnu]) * self.row_count
+    depths = array.array('q', [0]) * self.row_count
+    first = self.first_uid
+    parents = self.topology.parents
+    def depth(tnu):
+      return depths[tnu - first] if tnu != forest_tnu else -1
+    def jump(tnu):
+      return self.jumps[tnu - first] if tnu != forest_tnu else forest_tnu
+    count = [0]
+    def enter(tnu, passed):
       assert tnu > 0
-      self.sequence_numbers[tnu] = n
-      n = n + 1
-      for inf in get_raw_children(tnu):
-        n = process(inf, n)
-      for inf in get_raw_synonyms(tnu):
-        n = process(inf, n)
-      return n
-    for root in get_roots(self):
-      n = process(root, n)
+      self.sequence_numbers[tnu - first] = count[0]
+      count[0] += 1
+      parent = parents[tnu - first]
+      if parent != forest_tnu:
+        depths[tnu - first] = depth(parent) + 1
+        j = jump(parent)
+        if depth(parent) - depth(j) == depth(j) - depth(jump(j)):
+          self.jumps[tnu - first] = jump(j)
+        else:
+          self.jumps[tnu - first] = parent
+    def leave(tnu, results):
+      self.sequence_ends[tnu - first] = count[0]
+    traverse.walk(get_roots(self), get_inferiors, pre=enter, post=leave)
 
 # Sequence number within this checklist
 
 def get_sequence_number(uid):
-  return get_checklist(uid).sequence_numbers[uid]
+  checklist = get_checklist(uid)
+  return checklist.sequence_numbers[uid - checklist.first_uid]
+
+# Rows by sequence number (-1 past the last, if some records aren't
+# reached from a root)
+
+def rows_in_preorder(checklist):
+  by_number = array.array('q', [-1]) * checklist.row_count
+  numbers = checklist.sequence_numbers
+  for row in range(checklist.row_count):
+    if numbers[row] >= 0: by_number[numbers[row]] = row
+  return by_number
+
+# The given nodes of a checklist, in postorder (the order in which a
+# walk leaves them): a subtree ends after all of its descendants
+
+def in_postorder(checklist, nodes):
+  first = checklist.first_uid
+  numbers = checklist.sequence_numbers
+  ends = checklist.sequence_ends
+  return sorted(nodes, key=lambda node: (ends[node - first],
+                                         -numbers[node - first]))
 
 # Read a checklist from a file
 
+# If use_cache is set, a checklist read from a file is saved in binary
+# form next to it (see cache.py) and reloaded from there next time.
+
+use_cache = True
+
+# Number of processes to use for reading a large checklist (and for
+# choosing best matches; see intension.best_candidates_in_parallel)
+
+jobs = 1
+
+# Properties to keep besides the required ones, or None to keep every
+# property listed in property.py.  Columns not kept are dropped as the
+# file is parsed.
+
+properties = None
+
+# If set, a TSV checklist that isn't cached is read lazily (see
+# Table.populate_lazily): only key_fields are parsed as the file is
+# read.  Such a checklist isn't cached, since that would mean parsing
+# everything.
+
+lazy = False
+
 def read_checklist(specifier, prefix, name):
   assert prefix
   checklist = Checklist(prefix, name)
+  if properties != None:
+    checklist.projection = set(prop.uid
+                               for prop in required_fields + properties)
+  cached = None
   if specifier.endswith(')'):
-    checklist.populate_from_generator(chaitin.parse(specifier))
+    checklist.populate_from_generator(chaitin.parse(specifier),
+                                      indexed_fields)
   else:
-    checklist.populate_from_file(specifier)
+    # A DwC-A directory or zip file stands for its taxon file
+    specifier = dwca.taxon_path(specifier)
+    if use_cache:
+      cached = cache.load(checklist, specifier, cache_key(specifier))
+    if cached == None:
+      if lazy:
+        checklist.populate_lazily(specifier, key_fields, indexed_fields)
+      else:
+        checklist.populate_from_file(specifier, indexed_fields, jobs)
 
   assert checklist.get_position(canonical_name) != None
   if checklist.get_position(taxon_id) == None:
     print (checklist.header())
     assert False
 
-  validate(checklist)
-  checklist.assign_sequence_numbers()
+  if cached != None:
+    checklist.topology = topology.Topology(cached)
+    checklist.validation = cached["validation"]
+    checklist.sequence_numbers = cached["sequence_numbers"]
+    checklist.sequence_ends = cached["sequence_ends"]
+    checklist.jumps = cached["jumps"]
+    (acc_count, syn_count) = checklist.validation
+    dribble.log("# Validated %s accepted nodes, %s synonyms, total %s" %
+                (acc_count, syn_count, acc_count + syn_count))
+  else:
+    checklist.topology = \
+      topology.build_topology(checklist, taxon_id, parent_taxon_id,
+                              accepted_taxon_id)
+    validate(checklist)
+    checklist.assign_sequence_numbers()
+    if use_cache and not specifier.endswith(')') and not checklist.is_lazy():
+      arrays = checklist.topology.arrays()
+      arrays["validation"] = checklist.validation
+      arrays["sequence_numbers"] = checklist.sequence_numbers
+      arrays["sequence_ends"] = checklist.sequence_ends
+      arrays["jumps"] = checklist.jumps
+      cache.save(checklist, specifier, cache_key(specifier), arrays)
+  assign_mutexes(checklist)
 
   return checklist
 
-# Utility - copied from another file - really ought to be shared
-# Is this used?  Could be
+# Per-record arrays saved with a cached checklist
+
+cached_arrays = topology.names + ["validation", "sequence_numbers",
+                                  "sequence_ends", "jumps"]
+
+# Whatever, besides the file itself, determines the contents of a
+# cached checklist
+
+def cache_key(specifier):
+  meta = dwca.find_meta(specifier)
+  return {"indexed": [prop.pet_name for prop in indexed_fields],
+          "arrays": cached_arrays,
+          "properties": (None if properties == None else
+                         sorted(prop.pet_name
+                                for prop in required_fields + properties)),
+          "meta": meta and (meta["header_lines"], meta["id_position"],
+                            meta["terms"])}
+
+# The taxon file of a DwC-A, given as a directory or zip file
 
 def get_nodes_file_path(dwca_dir):
-  for name in ["taxon.tsv",
-               "Taxon.tsv",
-               "taxon.tab",
-               "Taxon.tab",
-               "taxa.txt",
-               "taxon.txt",
-               "Taxon.txt"]:
-    path = os.path.join(dwca_dir, name)
-    if os.path.exists(path):
-      return path
-  raise ValueError("cannot find taxon file in this directory", dwca_dir)
+  return dwca.taxon_path(dwca_dir)
 
 # -------------------- indexing
 
@@ -168,6 +321,12 @@ def get_spaceless(tnu):
   if tnu == None: return "none"
   if tnu == forest_tnu: return "forest"
   assert table.is_record(tnu)
+  checklist = get_checklist(tnu)
+  if checklist.topology == None:
+    return compute_spaceless(tnu)
+  return unique_names(checklist)[tnu - checklist.first_uid][len(checklist.prefix):]
+
+def compute_spaceless(tnu):
   checklist = get_checklist(tnu)
   name = get_name(tnu)
 
@@ -186,10 +345,42 @@ def get_spaceless(tnu):
 
 def get_unique(tnu):
   if tnu:
-    return get_checklist(tnu).prefix + get_spaceless(tnu)
+    checklist = get_checklist(tnu)
+    if checklist.topology == None:
+      return checklist.prefix + compute_spaceless(tnu)
+    return unique_names(checklist)[tnu - checklist.first_uid]
   else:
     return get_spaceless(tnu)
 
+# Unique names (with prefix) of all of a checklist's records, by row.
+# Made on first use, in one pass over the name columns, the same way
+# compute_spaceless makes them one at a time.
+
+def unique_names(checklist):
+  if checklist.unique_names == None:
+    count = checklist.row_count
+    names = [None] * count
+    for field in (canonical_name, scientific_name, taxon_id):
+      col = checklist.columns[field.uid]
+      if col != None:
+        names = [name if name != None else value
+                 for (name, value) in zip(names, col.values())]
+    ids = list(checklist.columns[taxon_id.uid].values())
+    idx = checklist.get_index(canonical_name)
+    (rows, key_of) = (idx.rows, idx.column.key_of)
+    flags = checklist.topology.accepted_flags
+    prefix = checklist.prefix
+    uniques = []
+    for row in range(count):
+      name = names[row]
+      if type(rows.get(key_of(name))) is list:
+        name = name + "#" + ids[row]
+      if not flags[row]:
+        name = "?" + name
+      uniques.append(prefix + name)
+    checklist.unique_names = uniques
+  return checklist.unique_names
+
 # Roots - accepted tnus without parents
 
 def get_roots(checklist):
@@ -203,15 +394,13 @@ def get_roots(checklist):
 # ----------
 # Parent/children and accepted/synonyms
 
+# These use the checklist's topology.  The get_raw_ versions go to the
+# columns and indexes, and are for use before there is a topology.
+
 def get_parent(tnu):
   assert tnu > 0
-  assert is_accepted(tnu)   # fails with gbif
-  parent = get_raw_parent(tnu)
-  if parent:
-    assert is_accepted(parent)
-    return parent
-  else:
-    return forest_tnu
+  checklist = get_checklist(tnu)
+  return checklist.topology.parents[tnu - checklist.first_uid]
 
 def get_raw_parent(node):
   parent_id = get_value(node, parent_taxon_id)
@@ -220,12 +409,10 @@ def get_raw_parent(node):
   return None
 
 def get_children(parent):
-  children = get_raw_children(parent)
-  if len(children) > 0:
-    assert is_accepted(parent)
-    for child in children:
-      assert is_accepted(child)
-  return children
+  checklist = get_checklist(parent)
+  topo = checklist.topology
+  row = parent - checklist.first_uid
+  return topo.children[topo.child_starts[row] : topo.child_starts[row + 1]].tolist()
 
 def get_raw_children(parent):
   return get_nodes_with_value(get_checklist(parent),
@@ -238,8 +425,8 @@ def get_raw_children(parent):
 # Returns None if this record has no accepted record
 
 def get_accepted(tnu):
-  # tbd: add assertions
-  return get_raw_accepted(tnu)
+  checklist = get_checklist(tnu)
+  return checklist.topology.accepteds[tnu - checklist.first_uid] or None
 
 def get_raw_accepted(tnu):
   probe = get_value(tnu, accepted_taxon_id)
@@ -249,12 +436,10 @@ def get_raw_accepted(tnu):
     return None
 
 def get_synonyms(tnu):
-  syns = get_raw_synonyms(tnu)
-  if len(syns) > 0:
-    assert is_accepted(tnu)
-    for syn in syns:
-      assert not is_accepted(syn)
-  return syns
+  checklist = get_checklist(tnu)
+  topo = checklist.topology
+  row = tnu - checklist.first_uid
+  return topo.synonyms[topo.synonym_starts[row] : topo.synonym_starts[row + 1]].tolist()
 
 def get_raw_synonyms(tnu):
   return get_nodes_with_value(get_checklist(tnu),
@@ -262,6 +447,12 @@ def get_raw_synonyms(tnu):
                               get_taxon_id(tnu))
   # return [syn for syn in ...]
 
+# Children followed by synonyms: the nodes directly below this one in
+# the full hierarchy (see traverse.py)
+
+def get_inferiors(tnu):
+  return get_children(tnu) + get_synonyms(tnu)
+
 def get_taxonomic_status(tnu):
   return get_value(tnu, taxonomic_status)
 
@@ -269,12 +460,14 @@ def get_nomenclatural_status(tnu):
   return get_value(tnu, nomenclatural_status)
 
 def is_accepted(tnu):
-  if get_value(tnu, accepted_taxon_id):
-    assert get_raw_children(tnu) == []
-    assert get_raw_synonyms(tnu) == []
-    return False
-  else:
-    return True
+  if tnu == forest_tnu: return True
+  checklist = get_checklist(tnu)
+  if checklist.topology == None:
+    return is_raw_accepted(tnu)
+  return checklist.topology.accepted_flags[tnu - checklist.first_uid] == 1
+
+def is_raw_accepted(tnu):
+  return not get_value(tnu, accepted_taxon_id)
 
 # Get canonical record among a set of equivalent records
 
@@ -288,48 +481,99 @@ def to_accepted(tnu):
   else:
     return tnu
 
+# Validation: a synonym (a record with an accepted id) can't have a
+# parent, children, or synonyms of its own, and its accepted id must
+# resolve.  Accepted records are then consistent automatically.  The
+# check is one pass over the synonyms' rows in the topology arrays.
+# All violations are counted, by kind, and the first few described;
+# then the checklist is rejected.
+
+# The verdict is kept in the checklist cache (the 'validation' array),
+# so an unchanged checklist isn't validated again.
+
+max_violation_reports = 10
+
 def validate(checklist):
+  topo = checklist.topology
+  count = checklist.row_count
+  first = checklist.first_uid
+  flags = topo.accepted_flags
+  col = checklist.columns[parent_taxon_id.uid]
+  if col == None:
+    parent_keys = [None] * count
+    no_parent = (None,)
+  else:
+    parent_keys = col.keys(0, count)
+    no_parent = col.missing_keys
+  (child_starts, synonym_starts) = (topo.child_starts, topo.synonym_starts)
+  accepteds = topo.accepteds
+  violations = {"have a parent id": [],
+                "have children": [],
+                "have synonyms": [],
+                "have an accepted id that doesn't resolve": []}
+  (with_parent, with_children, with_synonyms, unresolved) = violations.values()
   syn_count = 0
-  acc_count = 0
-  for node in checklist.get_all_nodes():
-    parent_id = get_value(node, parent_taxon_id)
-    accepted_id = get_value(node, accepted_taxon_id)
-    status = get_taxonomic_status(node)
-    if accepted_id:
-      # assert is_synonym_status(status)  - we actually don't know
-      # It's a synonym.  No parent, children, or synonyms allowed.
-      assert not parent_id
-      assert len(get_raw_children(node)) == 0
-      assert len(get_raw_synonyms(node)) == 0
-      assert accepted_id
-      a = get_raw_accepted(node)
-      if not a:
-        print("** %s (taxonID %s) has accepted id %s, which doesn't resolve" %
-              (get_unique(node), get_taxon_id(node), accepted_id))
-        assert a
-      syn_count += 1
-    else:
-      # It's accepted.  Parent and children must all
-      # also be accepted, and synonyms must not be.
-      assert not accepted_id
-      if parent_id:
-        # N.b. parent of a root is simply an undefined id
-        p = get_raw_parent(node)
-        if p:
-          assert is_accepted(p)
-      for child in get_raw_children(node):
-        assert is_accepted(child)
-      for syn in get_raw_synonyms(node):
-        assert not is_accepted(syn)
-      acc_count += 1
+  for row in range(count):
+    if flags[row]: continue
+    syn_count += 1
+    if parent_keys[row] not in no_parent: with_parent.append(row)
+    if child_starts[row + 1] > child_starts[row]: with_children.append(row)
+    if synonym_starts[row + 1] > synonym_starts[row]: with_synonyms.append(row)
+    if accepteds[row] == forest_tnu: unresolved.append(row)
+  problems = sum(len(rows) for rows in violations.values())
+  if problems > 0:
+    reported = 0
+    for (kind, rows) in violations.items():
+      if not rows: continue
+      dribble.log("# ** %s synonym(s) %s" % (len(rows), kind))
+      for row in rows[:max(0, max_violation_reports - reported)]:
+        node = first + row
+        dribble.log("# **   e.g. %s (taxonID %s, accepted id %s)" %
+                    (get_unique(node), get_taxon_id(node),
+                     get_value(node, accepted_taxon_id)))
+      reported += len(rows)
+    raise ValueError("invalid checklist: %s problems with synonyms" % problems,
+                     checklist.prefix)
+  checklist.validation = array.array('q', [count - syn_count, syn_count])
   dribble.log("# Validated %s accepted nodes, %s synonyms, total %s" %
-              (acc_count, syn_count, len(checklist.get_all_nodes())))
+              (count - syn_count, syn_count, count))
 
 def is_synonym_status(status):
   return "synonym" in status or status == "misapplied"
 
 # ---------- Hierarchy analyzers
 
+# Ancestry is decided by sequence numbers (see assign_sequence_numbers).
+# The old way, walking up from both nodes comparing mutexes
+# (find_peers), is used instead if use_intervals is off, and is also
+# run to check the answers if check_intervals is on.  The two differ
+# where ranks are inverted (a child ranked above its parent), since
+# find_peers assumes mutexes grow going tipward; so disagreements are
+# logged, not treated as errors.
+
+use_intervals = True
+check_intervals = False
+
+def check_interval_answer(what, args, answer, by_mutex):
+  if answer != by_mutex:
+    def show(x):
+      return get_unique(x) if type(x) is int else x.name
+    dribble.log("# %s(%s): %s by intervals, %s by mutexes" %
+                (what, ", ".join(map(show, args)),
+                 show(answer), show(by_mutex)))
+
+# Is tnu1 a proper ancestor of tnu2?  Both accepted, same checklist.
+
+def is_ancestor(tnu1, tnu2):
+  checklist = get_checklist(tnu1)
+  row1 = tnu1 - checklist.first_uid
+  n = checklist.sequence_numbers[tnu2 - checklist.first_uid]
+  return checklist.sequence_numbers[row1] < n < checklist.sequence_ends[row1]
+
+# A synonym is inside the proper ancestors of its accepted node, but
+# disjoint from the accepted node itself and from its other synonyms
+# (as find_peers has it).
+
 def how_related(tnu1, tnu2):
   if tnu1 == tnu2:
     # If in differently checklists, this could be an incompatibility
@@ -337,6 +581,22 @@ def how_related(tnu1, tnu2):
   assert table.is_record(tnu1)
   assert table.is_record(tnu2)
   assert get_checklist(tnu1) == get_checklist(tnu2)
+  if not use_intervals:
+    return how_related_by_mutex(tnu1, tnu2)
+  how = rel.disjoint
+  acc1 = to_accepted(tnu1)
+  acc2 = to_accepted(tnu2)
+  if acc1 != acc2:
+    if acc1 == tnu1 and is_ancestor(tnu1, acc2):
+      how = rel.gt
+    elif acc2 == tnu2 and is_ancestor(tnu2, acc1):
+      how = rel.lt
+  if check_intervals:
+    check_interval_answer("how_related", (tnu1, tnu2), how,
+                          how_related_by_mutex(tnu1, tnu2))
+  return how
+
+def how_related_by_mutex(tnu1, tnu2):
   (peer1, peer2) = find_peers(tnu1, tnu2)  
   if peer1 == peer2:
     if peer1 == tnu1:
@@ -345,14 +605,22 @@ def how_related(tnu1, tnu2):
       return rel.lt
   return rel.disjoint
 
+# Distinct accepted nodes neither of which contains the other.  (Two
+# records with the same accepted node aren't disjoint.)
+
 def are_disjoint(tnu1, tnu2):
   assert table.is_record(tnu1)
   assert table.is_record(tnu2)
   if tnu1 == forest_tnu: return False
   if tnu2 == forest_tnu: return False
   if tnu1 == tnu2: return False
-  (tnu1, tnu2) = find_peers(tnu1, tnu2)
-  return tnu1 != tnu2
+  if not use_intervals:
+    (tnu1, tnu2) = find_peers(tnu1, tnu2)
+    return tnu1 != tnu2
+  tnu1 = to_accepted(tnu1)
+  tnu2 = to_accepted(tnu2)
+  return (tnu1 != tnu2 and
+          not is_ancestor(tnu1, tnu2) and not is_ancestor(tnu2, tnu1))
 
 # Find ancestor(s) of tnu1 and/or tnu2 that are in the same mutex: either
 # disjoint or equal.
@@ -404,7 +672,26 @@ def find_peers(tnu_1, tnu_2):
 # Also computes number of matched tips
 # None (not 0) is the identity for mrca
 
+# As with how_related, two different records with the same accepted
+# node have that node's parent as their mrca (as find_peers has it).
+
 def mrca(tnu1, tnu2):
+  if tnu1 == forest_tnu: return forest_tnu
+  if tnu2 == forest_tnu: return forest_tnu
+  if tnu1 == tnu2: return tnu1
+  if not use_intervals:
+    return mrca_by_mutex(tnu1, tnu2)
+  acc1 = to_accepted(tnu1)
+  acc2 = to_accepted(tnu2)
+  if acc1 == acc2:
+    m = get_parent(acc1)
+  else:
+    m = common_ancestor(acc1, acc2)
+  if check_intervals:
+    check_interval_answer("mrca", (tnu1, tnu2), m, mrca_by_mutex(tnu1, tnu2))
+  return m
+
+def mrca_by_mutex(tnu1, tnu2):
   while True:
     if tnu1 == forest_tnu: return forest_tnu
     if tnu2 == forest_tnu: return forest_tnu
@@ -415,86 +702,188 @@ def mrca(tnu1, tnu2):
     (tnu1, tnu2) = find_peers(tnu1, tnu2)
     assert get_mutex(tnu1) == get_mutex(tnu2)
 
-mutex_table = {}
-
-def set_mutex(tnu, mutex):
-  have = mutex_table.get(tnu, mutex)
-  if have != mutex:
-    verb = "Promoting" if have > mutex else "Demoting"
-    print("# ** %s %s, %s -> %s" % \
-          (verb, get_unique(tnu),
-           rank.mutex_to_name(have),
-           rank.mutex_to_name(mutex)))
-  mutex_table[tnu] = mutex
+# Lowest common ancestor (or self) of two accepted nodes: climb from
+# tnu1, by jump pointer when that doesn't overshoot, until reaching a
+# node that contains tnu2.
+
+def common_ancestor(tnu1, tnu2):
+  checklist = get_checklist(tnu1)
+  first = checklist.first_uid
+  numbers = checklist.sequence_numbers
+  ends = checklist.sequence_ends
+  jumps = checklist.jumps
+  parents = checklist.topology.parents
+  n = numbers[tnu2 - first]
+  def contains(tnu):
+    return (tnu == forest_tnu or
+            numbers[tnu - first] <= n < ends[tnu - first])
+  tnu = tnu1
+  while not contains(tnu):
+    j = jumps[tnu - first]
+    tnu = parents[tnu - first] if contains(j) else j
+  return tnu
+
+# The mrca of all of the given nodes, i.e. mrca folded over them in
+# order, or None if there are none.  If they're all accepted, that's
+# just the common ancestor of the first and last in preorder.
+
+def mrca_of(nodes):
+  if len(nodes) == 0: return None
+  if len(nodes) == 1: return nodes[0]
+  if forest_tnu in nodes: return forest_tnu
+  if use_intervals and all(is_accepted(node) for node in nodes):
+    checklist = get_checklist(nodes[0])
+    first = checklist.first_uid
+    numbers = checklist.sequence_numbers
+    tnu1 = min(nodes, key=lambda tnu: numbers[tnu - first])
+    tnu2 = max(nodes, key=lambda tnu: numbers[tnu - first])
+    m = common_ancestor(tnu1, tnu2)
+    if check_intervals:
+      m2 = nodes[0]
+      for node in nodes[1:]:
+        m2 = mrca_by_mutex(m2, node)
+      check_interval_answer("mrca_of", nodes, m, m2)
+    return m
+  m = nodes[0]
+  for node in nodes[1:]:
+    m = mrca(m, node)
+  return m
+
+# Mutexes are computed for the whole checklist at once, after it's
+# read, and kept with it, so they go when it does.
 
 def get_mutex(tnu):
   if not tnu:
     # Above root of tree = forest_tnu
     return rank.forest
-  probe = mutex_table.get(tnu)
-  if probe: return probe
-  mutex = get_mutex_really(tnu)
-  assert mutex >= 0
-  mutex_table[tnu] = mutex    # Perhaps amended later
-  return mutex
+  checklist = get_checklist(tnu)
+  return checklist.mutexes[tnu - checklist.first_uid]
 
 # Higher numbers are more tipward.
 # Parent's level > child's level for all children.
 
-def get_mutex_really(tnu):
-  tnu = to_accepted(tnu)
-
-  # Findest most rootward mutex of all the children
-  children_mutex = rank.atom     # identity for min
-  for child in get_children(tnu):
-    children_mutex = min(children_mutex, get_mutex(child))
-
-  # Treat given rank, if any, as normative
-  if get_parent(tnu) == forest_tnu:
-    mutex = rank.root
-  else:
-    nominal = get_nominal_mutex(tnu)
-    mutex = nominal or (children_mutex - 10)
-  set_mutex(tnu, mutex)
-
-  # Demote children that have higher rank
-  correct_children_mutexes(tnu, mutex)
-
-  return mutex
-
-def correct_children_mutexes(parent, parent_mutex):
-  for child in get_children(parent):
-    child_mutex = get_mutex(child)
-    if child_mutex <= parent_mutex:
-      if child_mutex == parent_mutex:
-        dribble.log("# ** Child %s (%s) has same rank as parent %s" % \
-                    (get_unique(child),
-                     get_nominal_rank(child),
-                     get_unique(parent)))
-      else:
-        dribble.log("# ** Child %s (%s) is of higher rank than parent %s (%s)" %\
-                    (get_unique(child),
-                     get_nominal_rank(child),
-                     get_unique(parent),
-                     get_nominal_rank(parent)))
-      if is_container(child):
-        new_mutex = parent_mutex + 1 # demote!
-        set_mutex(child, new_mutex)
-        correct_children_mutexes(child, new_mutex) # ?
-      else:
-        set_mutex(child, parent_mutex + 10)  # demote!
+# A node's given rank, if any, is normative; otherwise it's just above
+# its most rootward child.  Roots are at rank.root.  Then any child not
+# below its parent is demoted (a container to just below the parent,
+# which can demote its own children in turn; anything else to well
+# below).  Nodes are done in reverse preorder, so children come before
+# parents.  A synonym has the mutex of its accepted node.
+
+# Demotions are logged individually only up to this many
+
+max_demotion_reports = 10
+
+def assign_mutexes(checklist):
+  assign_containers(checklist)
+  first = checklist.first_uid
+  count = checklist.row_count
+  mutexes = array.array('q', [rank.atom]) * count
+  checklist.mutexes = mutexes
+  by_number = rows_in_preorder(checklist)
+  parents = checklist.topology.parents
+  flags = checklist.topology.accepted_flags
+  containers = checklist.containers
+  demotions = [0, 0, 0]         # same rank, higher rank, containers
+
+  def demote(parent, parent_mutex):
+    # (parent, its mutex, remaining children) for each container being
+    # corrected
+    stack = [(parent, parent_mutex, iter(get_children(parent)))]
+    while stack:
+      (parent, parent_mutex, children) = stack[-1]
+      child = next(children, None)
+      if child == None:
+        stack.pop()
+        continue
+      child_mutex = mutexes[child - first]
+      if child_mutex <= parent_mutex:
+        if child_mutex == parent_mutex:
+          demotions[0] += 1
+          if sum(demotions[:2]) <= max_demotion_reports:
+            dribble.log("# ** Child %s (%s) has same rank as parent %s" % \
+                        (get_unique(child),
+                         get_nominal_rank(child),
+                         get_unique(parent)))
+        else:
+          demotions[1] += 1
+          if sum(demotions[:2]) <= max_demotion_reports:
+            dribble.log("# ** Child %s (%s) is of higher rank than parent %s (%s)" %\
+                        (get_unique(child),
+                         get_nominal_rank(child),
+                         get_unique(parent),
+                         get_nominal_rank(parent)))
+        if containers[child - first]:
+          demotions[2] += 1
+          mutexes[child - first] = parent_mutex + 1 # demote!
+          stack.append((child, parent_mutex + 1, iter(get_children(child))))
+        else:
+          mutexes[child - first] = parent_mutex + 10  # demote!
+
+  for number in range(count - 1, -1, -1):
+    row = by_number[number]
+    if row < 0 or not flags[row]: continue
+    tnu = first + row
+    # Findest most rootward mutex of all the children
+    children_mutex = rank.atom     # identity for min
+    for child in get_children(tnu):
+      children_mutex = min(children_mutex, mutexes[child - first])
+    if parents[row] == forest_tnu:
+      mutex = rank.root
+    else:
+      nominal = get_nominal_mutex(tnu)
+      mutex = nominal or (children_mutex - 10)
+    assert mutex >= 0
+    mutexes[row] = mutex
+    demote(tnu, mutex)
+
+  accepteds = checklist.topology.accepteds
+  for row in range(count):
+    if not flags[row]:
+      mutexes[row] = mutexes[accepteds[row] - first]
+
+  if demotions[0] + demotions[1] > 0:
+    dribble.log("# Demoted %s nodes not below their parents "
+                "(%s same rank, %s higher rank; %s containers)" %
+                (demotions[0] + demotions[1], demotions[0], demotions[1],
+                 demotions[2]))
 
 def get_nominal_mutex(tnu):
   nominal = get_nominal_rank(tnu) # name of rank
   return rank.name_to_mutex(nominal)
 
+# Container: a node that's a grab bag of things not otherwise placed,
+# as opposed to a taxon.  Decided by name, once for every record.
+
 def is_container(tnu):
-  name = get_name(tnu).lower()
+  checklist = get_checklist(tnu)
+  if checklist.containers == None:
+    return is_container_name(get_name(tnu))
+  return checklist.containers[tnu - checklist.first_uid] == 1
+
+def is_container_name(name):
+  if name == None: return False
+  name = name.lower()
   return "unclassified" in name or \
          "incertae sedis" in name or \
          "unallocated" in name or \
          "unassigned" in name
-  
+
+# Same as is_container_name(get_name(tnu)) for every record, straight
+# from the columns
+
+def assign_containers(checklist):
+  columns = [checklist.columns[prop.uid]
+             for prop in [canonical_name, scientific_name, taxon_id]
+             if checklist.columns[prop.uid] != None]
+  flags = array.array('B')
+  for row in range(checklist.row_count):
+    name = None
+    for col in columns:
+      name = col.get(row)
+      if name != None: break
+    flags.append(is_container_name(name))
+  checklist.containers = flags
+
 # ---------- General utility that doesn't really belong here
 
 def invert_dict(d):
@@ -506,6 +895,53 @@ def invert_dict(d):
       inv[val] = [key]
   return inv
 
+# ---------- Memo tables
+
+# Things worked out once per node (synonymy articulations,
+# see intension.py; record comparisons, see changes.py) are kept with
+# the node's checklist, so they go when it does.  Each kind of thing
+# remembered has its own table.  Hits and misses are counted; see
+# report_memos.
+
+class Memo:
+  def __init__(self):
+    self.values = {}
+    self.hits = 0
+    self.misses = 0
+
+_absent = object()
+
+def get_memo(node, kind):
+  checklist = get_checklist(node)
+  if checklist.memos == None: checklist.memos = {}
+  memo = checklist.memos.get(kind)
+  if memo == None:
+    memo = Memo()
+    checklist.memos[kind] = memo
+  return memo
+
+def recall(node, kind, key, compute):
+  memo = get_memo(node, kind)
+  value = memo.values.get(key, _absent)
+  if value is _absent:
+    memo.misses += 1
+    value = compute()
+    memo.values[key] = value
+  else:
+    memo.hits += 1
+  return value
+
+# Remember something worked out ahead of time (not counted as a miss)
+
+def remember(node, kind, key, value):
+  get_memo(node, kind).values.setdefault(key, value)
+
+def report_memos(checklist):
+  for (kind, memo) in (checklist.memos or {}).items():
+    dribble.log("# %s %s memo: %s entries, %s hits, %s misses" %
+                (checklist.prefix, kind, len(memo.values),
+                 memo.hits, memo.misses))
+
 # Test
 
 def self_test():
@@ -0,0 +1,357 @@
+# Columns: compact storage for the values of one property across all
+# the records of a table.
+
+# A column is filled in batches (extend) while a table is read, and
+# afterwards answers get(row), where row is the position of the record
+# within its table (0-based).  Values come back as strings, or None
+# for an empty field, exactly as the old per-record lists gave them.
+
+# extend returns False if the batch can't be represented by the
+# column's encoding; the caller then switches to a more general
+# column (see generalize) and tries again.
+
+import array, itertools, collections
+
+# ---------- Arbitrary text
+
+# All values are utf-8 encoded end to end in one buffer.
+# Value i occupies buffer[offsets[i] : offsets[i+1]].
+
+class TextColumn:
+  kind = "text"
+
+  def __init__(self):
+    self.buffer = bytearray()
+    self.offsets = array.array('q', [0])
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def get(self, row):
+    start = self.offsets[row]
+    end = self.offsets[row + 1]
+    if start == end: return None
+    return str(self.buffer[start:end], 'utf-8')
+
+  def extend(self, values):
+    encoded = [(value or '').encode('utf-8') for value in values]
+    self.buffer += b''.join(encoded)
+    ends = itertools.accumulate(map(len, encoded), initial=self.offsets[-1])
+    next(ends)                  # initial value is already there
+    self.offsets.extend(ends)
+    return True
+
+  def values(self):
+    for row in range(len(self)):
+      yield self.get(row)
+
+  def generalize(self):
+    return self
+
+  # Index keys are the values themselves
+
+  missing_keys = ('', None)
+
+  def keys(self, start, end):
+    return [self.get(row) for row in range(start, end)]
+
+  def key_of(self, value):
+    return value
+
+  def decode_key(self, key):
+    return key
+
+# ---------- Numeric identifiers (NCBI, GBIF, EOL)
+
+# Only values that survive a round trip through int() are accepted, so
+# '0042' or '+7' force a switch to text.  Missing values are stored as
+# -1.
+
+missing_int = -1
+
+class IntColumn:
+  kind = "int"
+
+  def __init__(self):
+    self.numbers = array.array('q')
+
+  def __len__(self):
+    return len(self.numbers)
+
+  def get(self, row):
+    n = self.numbers[row]
+    if n == missing_int: return None
+    return str(n)
+
+  def extend(self, values):
+    spelled = [value or '-1' for value in values]
+    try:
+      numbers = [int(value) for value in spelled]
+    except ValueError:
+      return False
+    # Round trip, and no negative numbers (-1 means missing)
+    if (','.join(map(str, numbers)) != ','.join(spelled) or
+        min(numbers, default=0) < missing_int or '-1' in values):
+      return False
+    try:
+      numbers = array.array('q', numbers)
+    except OverflowError:
+      return False
+    self.numbers.extend(numbers)
+    return True
+
+  def values(self):
+    for n in self.numbers:
+      yield None if n == missing_int else str(n)
+
+  def generalize(self):
+    text = TextColumn()
+    text.extend([value or '' for value in self.values()])
+    return text
+
+  # Index keys are the numbers.  A value that isn't stored as a number
+  # can't be in the column (key None).
+
+  missing_keys = (missing_int,)
+
+  def keys(self, start, end):
+    keys = self.numbers[start:end]
+    if type(keys) is memoryview:  # from a checklist cache
+      keys = array.array('q', keys.tobytes())
+    return keys
+
+  def key_of(self, value):
+    if type(value) is int: return value
+    try:
+      n = int(value)
+    except (ValueError, TypeError):
+      return None
+    return n if str(n) == value else None
+
+  def decode_key(self, key):
+    return str(key)
+
+# ---------- Low-cardinality values (ranks, statuses)
+
+# Dictionary encoded.  Code 0 is reserved for the empty value.
+
+max_codes = 1 << 16
+
+class CodeColumn:
+  kind = "code"
+
+  def __init__(self):
+    self.codes = array.array('H')
+    self.dictionary = [None]
+    self.code_index = {'': 0}
+
+  def __len__(self):
+    return len(self.codes)
+
+  def get(self, row):
+    return self.dictionary[self.codes[row]]
+
+  def encode(self, value):
+    code = self.code_index.get(value)
+    if code == None:
+      code = len(self.dictionary)
+      self.dictionary.append(value)
+      self.code_index[value] = code
+    return code
+
+  def extend(self, values):
+    lookup = self.code_index.get
+    codes = [lookup(value or '') for value in values]
+    if None in codes:
+      codes = [self.encode(value or '') for value in values]
+    if len(self.dictionary) > max_codes:
+      return False
+    self.codes.extend(codes)
+    return True
+
+  def values(self):
+    dictionary = self.dictionary
+    for code in self.codes:
+      yield dictionary[code]
+
+  def generalize(self):
+    text = TextColumn()
+    text.extend([value or '' for value in self.values()])
+    return text
+
+  # Index keys are the values themselves
+
+  missing_keys = ('', None)
+
+  def keys(self, start, end):
+    dictionary = self.dictionary
+    return [dictionary[code] for code in self.codes[start:end]]
+
+  def key_of(self, value):
+    return value
+
+  def decode_key(self, key):
+    return key
+
+# ---------- Fields left in the file (lazy reading)
+
+# The lines of a memory-mapped TSV file.  Line i occupies
+# data[offsets[i] : offsets[i+1]], newline included.  Recently split
+# lines are kept, least recently used going first once there are
+# more than cache_size of them: callers go back and forth between a
+# few records (comparing pairs, say), wanting several fields of each.
+# decodes counts the lines split.
+
+class Lines:
+  cache_size = 4096
+
+  def __init__(self, data, offsets):
+    self.data = data
+    self.offsets = offsets
+    self.cache = collections.OrderedDict()    # row -> fields
+    self.decodes = 0
+
+  def __len__(self):
+    return len(self.offsets) - 1
+
+  def get_fields(self, row):
+    cache = self.cache
+    fields = cache.get(row)
+    if fields == None:
+      line = str(self.data[self.offsets[row] : self.offsets[row + 1]], 'utf-8')
+      fields = line.rstrip("\r\n").split("\t")
+      self.decodes += 1
+      cache[row] = fields
+      if len(cache) > self.cache_size:
+        cache.popitem(last=False)
+    else:
+      cache.move_to_end(row)
+    return fields
+
+# A column whose values are split out of the lines only when asked for.
+# It can't be extended; generalize gives a text column holding the
+# same values.
+
+class LazyColumn:
+  kind = "lazy"
+
+  def __init__(self, lines, position):
+    self.lines = lines
+    self.position = position
+
+  def __len__(self):
+    return len(self.lines)
+
+  def get(self, row):
+    return self.value_in(self.lines.get_fields(row))
+
+  # This column's value in a record's split line
+
+  def value_in(self, fields):
+    if self.position >= len(fields): return None
+    return fields[self.position] or None
+
+  def extend(self, values):
+    return False
+
+  def values(self):
+    for row in range(len(self)):
+      yield self.get(row)
+
+  def generalize(self):
+    text = TextColumn()
+    text.extend(list(self.values()))
+    return text
+
+  # Index keys are the values themselves
+
+  missing_keys = ('', None)
+
+  def keys(self, start, end):
+    return [self.get(row) for row in range(start, end)]
+
+  def key_of(self, value):
+    return value
+
+  def decode_key(self, key):
+    return key
+
+kinds = {"text": TextColumn, "int": IntColumn, "code": CodeColumn}
+
+# Join columns holding consecutive runs of rows (e.g. parsed in
+# parallel) into one.  If the pieces ended up with different
+# encodings, they're all generalized first.
+
+def concatenate(cols):
+  kinds_present = set(col.kind for col in cols)
+  if len(kinds_present) > 1:
+    cols = [col.generalize() if col.kind != "text" else col for col in cols]
+  result = new_column(cols[0].kind)
+  if result.kind == "text":
+    for col in cols:
+      base = len(result.buffer)
+      result.buffer += col.buffer
+      result.offsets.extend([base + offset for offset in col.offsets[1:]])
+  elif result.kind == "int":
+    for col in cols:
+      result.numbers.extend(col.numbers)
+  else:
+    for col in cols:
+      # Translate this piece's codes into result's codes
+      mapping = [result.encode(value or '') for value in col.dictionary]
+      if mapping == list(range(len(mapping))):
+        result.codes.extend(col.codes)
+      else:
+        result.codes.extend([mapping[code] for code in col.codes])
+    if len(result.dictionary) > max_codes:
+      return concatenate([col.generalize() for col in cols])
+  return result
+
+def new_column(kind):
+  return kinds[kind]()
+
+# Rough number of bytes of storage held by a column (not counting
+# object overhead)
+
+def size_in_bytes(column):
+  if column.kind == "text":
+    return len(column.buffer) + column.offsets.itemsize * len(column.offsets)
+  elif column.kind == "int":
+    return column.numbers.itemsize * len(column.numbers)
+  elif column.kind == "lazy":
+    return 0                    # the file's lines are shared
+  else:
+    return column.codes.itemsize * len(column.codes)
+
+# ---------- Self-test
+
+def self_test():
+  for kind in kinds:
+    column = new_column(kind)
+    values = ['12', '', '7', None]
+    assert column.extend(values)
+    assert [column.get(i) for i in range(4)] == ['12', None, '7', None]
+  column = IntColumn()
+  assert column.extend(['1', '2'])
+  assert not column.extend(['3', '9443.1'])
+  assert not column.extend(['007'])
+  column = column.generalize()
+  assert column.extend(['9443.1', ''])
+  assert list(column.values()) == ['1', '2', '9443.1', None]
+  pieces = [new_column("code"), new_column("code")]
+  pieces[0].extend(['a', 'b', ''])
+  pieces[1].extend(['b', 'c'])
+  assert list(concatenate(pieces).values()) == ['a', 'b', None, 'b', 'c']
+  pieces = [new_column("int"), new_column("text")]
+  pieces[0].extend(['1', ''])
+  pieces[1].extend(['x'])
+  assert list(concatenate(pieces).values()) == ['1', None, 'x']
+  data = b"1\ta\tb\n2\t\n3\tc\td\r\n"
+  lines = Lines(memoryview(data), array.array('q', [0, 6, 9, 17]))
+  column = LazyColumn(lines, 2)
+  assert list(column.values()) == ['b', None, 'd']
+  assert list(column.generalize().values()) == ['b', None, 'd']
+  print("column self-test OK")
+
+if __name__ == '__main__':
+  self_test()
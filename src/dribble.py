@@ -1,10 +1,17 @@
 
 import sys
-import checklist as cl
 
 dribble_file = None
 
+# If this is a list, messages are added to it instead of being written
+# (e.g. in a worker process, so the parent can log them in order)
+
+captured = None
+
 def log(message):
+  if captured != None:
+    captured.append(message)
+    return
   print(message)
   if dribble_file:
     print(message, file=dribble_file)
@@ -15,6 +22,7 @@ def log(message):
 confusing = '...'
 
 def watch(node):
+  import checklist as cl    # not at top; table.py workers import us first
   if node != None and node != cl.forest_tnu:
     return cl.get_name(node).startswith(confusing)
   return False
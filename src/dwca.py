@@ -0,0 +1,139 @@
+# Darwin Core archive support: locating the core (taxon) file, reading
+# files straight out of a zip archive, and the meta.xml file that
+# describes the columns of the core file.
+
+# Only the core file is of interest.  Its description gives, for each
+# column position, the URI of the term stored there, which is a more
+# reliable way to identify columns than header labels (and the only
+# way if the file has no header row).
+
+# A path may lead into a zip file as if it were a directory, e.g.
+# backbone.zip/Taxon.tsv or taxdmp.zip/nodes.dmp.  Members are
+# decompressed as they're read, so archives needn't be unpacked.
+
+import os, io, zipfile
+import xml.etree.ElementTree as ET
+
+import property
+
+text_ns = "{http://rs.tdwg.org/dwc/text/}"
+
+# Returns a dict describing the core file, or None:
+#   location      - file name of the core file, relative to the archive
+#   header_lines  - number of header lines (0 or 1, usually)
+#   id_position   - position of the record id column, if given
+#   terms         - list of term URIs by column position (None for gaps)
+
+def parse_meta(text):
+  root = ET.fromstring(text)
+  core = root.find(text_ns + "core")
+  if core == None: return None
+  location = core.find(text_ns + "files/" + text_ns + "location")
+  fields = {}
+  for field in core.findall(text_ns + "field"):
+    position = field.get("index")
+    if position != None:
+      fields[int(position)] = field.get("term")
+  id_field = core.find(text_ns + "id")
+  width = max(fields, default=-1) + 1
+  terms = [fields.get(position) for position in range(width)]
+  return {"location": location.text.strip() if location != None else None,
+          "header_lines": int(core.get("ignoreHeaderLines", "0")),
+          "id_position": int(id_field.get("index")) if id_field != None else None,
+          "terms": terms}
+
+# If there's a meta.xml beside the given file, and it describes that
+# file, return the description
+
+def find_meta(path):
+  meta_path = os.path.join(os.path.dirname(path), "meta.xml")
+  if not exists(meta_path): return None
+  with open_text(meta_path) as infile:
+    meta = parse_meta(infile.read())
+  if meta and meta["location"] == os.path.basename(path):
+    return meta
+  return None
+
+# Column labels to use in place of the file's header row.  A column
+# whose term we know gets that property's pet name; other columns are
+# labeled with their term URI (or nothing), which by_name won't match.
+
+def labels(meta):
+  result = []
+  for (position, term) in enumerate(meta["terms"]):
+    prop = property.properties_by_uri.get(term) if term else None
+    if prop:
+      result.append(prop.pet_name)
+    elif term == None and position == meta["id_position"]:
+      result.append("taxonID")
+    else:
+      result.append(term or "")
+  if meta["id_position"] != None and meta["id_position"] >= len(result):
+    result += [""] * (meta["id_position"] - len(result)) + ["taxonID"]
+  return result
+
+# ---------- Files in archives
+
+# Returns (archive, member) if path leads into a zip file, otherwise
+# (path, None)
+
+def split_archive(path):
+  if os.path.exists(path): return (path, None)
+  (head, member) = os.path.split(path)
+  while head and not os.path.exists(head):
+    (head, tail) = os.path.split(head)
+    member = tail + "/" + member
+  if head and os.path.isfile(head) and zipfile.is_zipfile(head):
+    return (head, member)
+  return (path, None)
+
+def in_archive(path):
+  return split_archive(path)[1] != None
+
+def exists(path):
+  (archive, member) = split_archive(path)
+  if member == None: return os.path.exists(path)
+  with zipfile.ZipFile(archive) as z:
+    return member in z.namelist()
+
+# Open for reading as text, like open(path, "r")
+
+def open_text(path):
+  (archive, member) = split_archive(path)
+  if member == None: return open(path, "r")
+  with zipfile.ZipFile(archive) as z:
+    # The member stays readable after the archive is closed
+    return io.TextIOWrapper(z.open(member), encoding="utf-8")
+
+# Names the core file of a DwC-A is likely to have
+
+taxon_file_names = ["taxon.tsv",
+                    "Taxon.tsv",
+                    "taxon.tab",
+                    "Taxon.tab",
+                    "taxa.txt",
+                    "taxon.txt",
+                    "Taxon.txt"]
+
+# Given a directory or zip file, the path of the taxon file in it (the
+# one meta.xml names, if there's a meta.xml).  Any other path is
+# returned as is.
+
+def taxon_path(path):
+  if os.path.isdir(path):
+    names = os.listdir(path)
+  elif os.path.isfile(path) and zipfile.is_zipfile(path):
+    with zipfile.ZipFile(path) as z:
+      names = z.namelist()
+  else:
+    return path
+  candidates = taxon_file_names
+  if "meta.xml" in names:
+    with open_text(os.path.join(path, "meta.xml")) as infile:
+      meta = parse_meta(infile.read())
+    if meta and meta["location"]:
+      candidates = [meta["location"]] + candidates
+  for name in candidates:
+    if name in names:
+      return os.path.join(path, name)
+  raise ValueError("cannot find taxon file in this directory", path)
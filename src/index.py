@@ -0,0 +1,89 @@
+# Indexes: value -> records having that value, for one column of one table
+
+# Keys are the column's own representation of values (ints for integer
+# columns, strings otherwise), and the index stores row numbers within
+# the table rather than record uids.  A key held by a single row (the
+# usual case for identifiers and names) maps directly to that row;
+# only keys shared by several rows get a list.
+
+# Lookups take and give the same things the old dict-of-lists did:
+# index.get(value) returns a list of record uids.
+
+import sys
+
+class Index:
+  def __init__(self, col):
+    self.column = col
+    self.rows = {}
+    self.base = 0               # uid of row 0, set when table is registered
+    self.record_count = 0       # number of rows indexed
+
+  def __len__(self):
+    return len(self.rows)
+
+  def __iter__(self):
+    decode = self.column.decode_key
+    for key in self.rows:
+      yield decode(key)
+
+  def __contains__(self, value):
+    return self.column.key_of(value) in self.rows
+
+  def __getitem__(self, value):
+    uids = self.get(value)
+    if uids == None: raise KeyError(value)
+    return uids
+
+  def get(self, value, default = None):
+    have = self.rows.get(self.column.key_of(value))
+    if have == None: return default
+    base = self.base
+    if type(have) is int:
+      return [base + have]
+    return [base + row for row in have]
+
+  def keys(self):
+    return iter(self)
+
+  # Add keys for rows first_row, first_row+1, ...  Most batches have no
+  # duplicate keys, and those can be added wholesale.
+
+  def add(self, first_row, keys):
+    missing = self.column.missing_keys
+    rows = self.rows
+    fresh = dict(zip(keys, range(first_row, first_row + len(keys))))
+    absent = 0
+    for m in missing:
+      if m in fresh:
+        del fresh[m]
+        absent += keys.count(m)
+    self.record_count += len(keys) - absent
+    if len(fresh) == len(keys) - absent and fresh.keys().isdisjoint(rows):
+      rows.update(fresh)
+      return
+    row = first_row
+    for key in keys:
+      if not key in missing:
+        have = rows.get(key)
+        if have == None:
+          rows[key] = row
+        elif type(have) is int:
+          rows[key] = [have, row]
+        else:
+          have.append(row)
+      row += 1
+
+  # Approximate storage in bytes
+
+  def size_in_bytes(self):
+    size = sys.getsizeof(self.rows)
+    for have in self.rows.values():
+      if type(have) is not int:
+        size += sys.getsizeof(have)
+    return size
+
+def build_index(col, batch_size = 100000):
+  index = Index(col)
+  for start in range(0, len(col), batch_size):
+    index.add(start, col.keys(start, min(start + batch_size, len(col))))
+  return index
@@ -1,6 +1,10 @@
+import multiprocessing
+
 import checklist as cl
 import articulation as art
 import relation as rel
+import candidates
+import changes
 import dribble
 
 # Temporary hack for experimenting with poorly formed EOL checklists
@@ -10,64 +14,164 @@ EOL = False
 
 # The source node ('node') may be accepted or a synonym.
 
+# The candidates for all of a checklist's nodes are found at once (see
+# candidates.py); then each node's best match is chosen from among its
+# own, without making articulations for the losers.  The candidates
+# both ways are compared first, all at once (see compare_candidates).
+
 def best_intensional_match_map(A, B):
-  best = {}
-  def process(here, there):
-    for node in here.get_all_nodes():
-      if cl.is_accepted(node) and not node in best:
-        ar = best_intensional_match(node, there)
-        if dribble.watch(node):
-          dribble.log("# Best: %s" % art.express(ar))
-        if ar:
-          assert ar.dom == node
-          assert cl.is_accepted(ar.cod)
-          art.half_proclaim(best, ar)
-  process(A, B)
-  process(B, A)
+  best = art.Alignment()
+  tables = [candidates.candidate_table(A, B, source_synonyms),
+            candidates.candidate_table(B, A, source_synonyms)]
+  kepts = [kept_candidates(table) for table in tables]
+  compare_candidates(tables, kepts)
+  for (table, kept) in zip(tables, kepts):
+    if cl.jobs > 1 and len(table) >= min_parallel_candidates:
+      chosen = best_candidates_in_parallel(table, kept, cl.jobs)
+    else:
+      chosen = best_candidates(table, kept)
+    for (node, winner, ties) in chosen:
+      if node in best: continue
+      if winner == None:
+        report_ties(node, [table.cods[i] for i in ties])
+        ar = None
+      else:
+        ar = candidate_articulation(table, winner)
+      if dribble.watch(node):
+        dribble.log("# Best: %s" % art.express(ar))
+      if ar:
+        assert ar.dom == node
+        assert cl.is_accepted(ar.cod)
+        art.half_proclaim(best, ar)
   dribble.log("%s best matches" % len(best))
+  cl.report_memos(A)
+  cl.report_memos(B)
   return best
 
-# Three components: synonym-or-self o direct o synonym-of-or-self
-# from_accepted_articulations o direct_matches o [to_accepted_articulation]
-
-def best_intensional_match(node, other):
-  matches = intensional_matches(node, other)
-  return choose_best_match(matches)
-
-# Matches where the target is accepted.  This is going away soon...
-
-def intensional_matches(node, other):
-  matches = weak_intensional_matches(node, other)
-  matches = art.collapse_matches(matches)
-  return matches
-
-# Like strong matches, but adds matches via source synonyms
-
-def weak_intensional_matches(node, other):
-  matches = strong_intensional_matches(node, other)
-  syns = synonyms_locally(node)
-  assert not syns or syns[0].dom == node
-  matches = matches + [art.compose(syn, match)
-                       for syn in syns
-                       for match in strong_intensional_matches(syn.cod, other)
-                       if art.composable(syn, match)]
-  assert is_matches(matches)
-  return matches
-
-def strong_intensional_matches(node, other):
-  matches = art.direct_matches(node, other)
-  assert is_matches(matches)
-  matches = [match_to_accepted(match) for match in matches]
-  assert is_matches(matches)
-  return matches
-
-# Convert match a->b to a->b' where b' is accepted (maybe b=b')
-
-def match_to_accepted(m):
-  if cl.is_accepted(m.cod):
-    return m
-  else:
-    return art.compose(m, has_accepted_locally(m.cod))
+# The articulation for a row of a candidate table: the direct match,
+# preceded by the hop from dom to its synonym and/or followed by the
+# hop from the synonym to cod
+
+def candidate_articulation(table, i):
+  dom = table.doms[i]
+  cod = table.cods[i]
+  source = table.dom_synonyms[i] or dom
+  hit = table.cod_synonyms[i] or cod
+  ar = art.intensional(source, hit, table.get_property(i).pet_name)
+  if hit != cod:
+    ar = art.compose(ar, has_accepted_locally(hit))
+  if source != dom:
+    ar = art.compose(accepted_has_locally(source), ar)
+  return ar
+
+# The candidates that collapse_matches would keep (applied twice), as
+# (dom, rows) for each of the table's doms
+
+def kept_candidates(table):
+  return [(dom, collapse_rows(table, collapse_rows(table, range(start, end))))
+          for (dom, start, end) in table.groups()]
+
+# Compare the records of the kept candidates of all the tables at once
+# (see changes.remember_differences), so that scoring them finds the
+# comparisons remembered
+
+def compare_candidates(tables, kepts):
+  changes.remember_differences([table.doms[i]
+                                for (table, kept) in zip(tables, kepts)
+                                for (_, rows) in kept for i in rows],
+                               [table.cods[i]
+                                for (table, kept) in zip(tables, kepts)
+                                for (_, rows) in kept for i in rows])
+
+# Choose among each dom's kept candidates.  Yields (dom, winner, ties)
+# for each dom, where ties are the rows of the least bad candidates and
+# winner is the row of the only one, or None if there's more than one.
+# The candidates are scored once each, by packed badness, and the least
+# score wins.
+
+def best_candidates(table, kept):
+  for (dom, rows) in kept:
+    scores = [candidate_badness(table, i) for i in rows]
+    least = min(scores)
+    ties = [i for (i, score) in zip(rows, scores) if score == least]
+    yield (dom, ties[0] if len(ties) == 1 else None, ties)
+
+# With cl.jobs > 1, the doms are split into consecutive shards and
+# their candidates scored in a process pool.  Workers are forked, so
+# they share the checklists, the candidate table and the remembered
+# comparisons (see compare_candidates) with this process rather than
+# getting pickled copies; only the (dom, winner, ties) results come
+# back.  Anything a worker remembers is lost with it.  Results arrive in shard order, so the best map
+# comes out the same as a serial run's.  Where processes can't be
+# forked, or there are few candidates, scoring is serial.
+
+min_parallel_candidates = 10000
+
+_shared_table = None            # the table being scored, for workers
+
+def best_candidates_in_parallel(table, kept, jobs):
+  global _shared_table
+  if not "fork" in multiprocessing.get_all_start_methods():
+    dribble.log("# Can't fork; choosing best matches serially")
+    return best_candidates(table, kept)
+  step = max(len(kept) // (jobs * 4), 1)
+  shards = [kept[i : i + step] for i in range(0, len(kept), step)]
+  _shared_table = table
+  try:
+    with multiprocessing.get_context("fork").Pool(jobs) as pool:
+      chosen = [result
+                for results in pool.imap(best_in_shard, shards)
+                for result in results]
+  finally:
+    _shared_table = None
+  dribble.log("# Chose best matches for %s nodes in %s shards, %s jobs" %
+              (len(kept), len(shards), jobs))
+  return chosen
+
+# Runs in a worker process
+
+def best_in_shard(kept):
+  return list(best_candidates(_shared_table, kept))
+
+# Packed badness (see art.pack_badness) of the articulation that
+# candidate_articulation would make.  Candidates relate accepted nodes
+# by ~; each synonym hop is another factor.
+
+def candidate_badness(table, i):
+  dom = table.doms[i]
+  cod = table.cods[i]
+  factor_count = (1 + (table.dom_synonyms[i] != 0)
+                    + (table.cod_synonyms[i] != 0))
+  return art.pack_badness(rel.matches,
+                          changes.differences(dom, cod),
+                          factor_count,
+                          cl.get_mutex(cod))
+
+# The rows that collapse_matches would keep, given the candidate
+# articulations for rows: sorted by codomain, with the later of two rows
+# for the same codomain standing for both.
+
+def collapse_rows(table, rows):
+  if len(rows) <= 1: return list(rows)
+  cods = table.cods
+  previous = None
+  kept = []
+  for i in sorted(rows, key=lambda i: cods[i]):
+    if previous == None:
+      previous = i
+    elif cods[i] == cods[previous]:
+      previous = i
+    else:
+      kept.append(previous)
+      previous = None
+  if previous != None:
+    kept.append(previous)
+  return kept
+
+# The synonyms whose matches count as an accepted node's own
+
+def source_synonyms(node):
+  return [syn.cod for syn in synonyms_locally(node)]
 
 # ---------- Within-checklist articulations
 
@@ -80,11 +184,17 @@ def match_to_accepted(m):
 
 def synonyms_locally(node):
   if cl.is_accepted(node):
-    hases = [has_accepted_locally(syn) for syn in informative_synonyms(node)]
-    return art.collapse_matches([art.reverse(ar) for ar in hases if ar])
+    syns = informative_synonyms(node)
+    if not syns: return []
+    return compute_synonyms_locally(syns)
   else:
     return []
 
+def compute_synonyms_locally(syns):
+  hases = [has_accepted_locally(syn) for syn in syns]
+  return art.collapse_matches([accepted_has_locally(ar.dom)
+                               for ar in hases if ar])
+
 def informative_synonyms(node):
   if False:
     return [syn
@@ -114,46 +224,34 @@ canonical_name = cl.field("canonicalName")
 
 def has_accepted_locally(maybe_syn):   # goes from synonym to accepted
   assert maybe_syn > 0
+  return cl.recall(maybe_syn, "synonymy", maybe_syn,
+                   lambda: compute_has_accepted(maybe_syn))
+
+def compute_has_accepted(maybe_syn):
   accepted = cl.to_accepted(maybe_syn)
   if accepted != maybe_syn:
     return art.synonymy(maybe_syn, accepted)
   else:
     return None
 
-# ---------- Best match among a set with common domain
+# The reverse: accepted to synonym
 
-def choose_best_match(arts):     # => art
-  assert is_matches(arts)
-  if len(arts) == 0: return None
-  arts = skim_best_matches(arts)
-  b = arts[0]
-  if len(arts) == 1: return b
-  dribble.log("** Multiple least-bad matches. Need to find tie-breakers.")
-  dribble.log("   %s -> %s" %
-              (cl.get_unique(b.dom),
-               [cl.get_unique(a.cod) for a in arts]))
-  return None
+def accepted_has_locally(syn):
+  return cl.recall(syn, "reverse synonymy", syn,
+                   lambda: art.reverse(has_accepted_locally(syn)))
 
-# There can be multiple best matches
+# ---------- Ties
 
-def skim_best_matches(arts):
-  if len(arts) == 0:
-    return []
-  else:
-    sorted_matches = art.sort_matches(art.collapse_matches(arts))
-    badness = art.badness(sorted_matches[0])
-    matches = []
-    for match in sorted_matches:
-      if art.badness(match) == badness:
-        matches.append(match)
-      else:
-        break
-    return matches
+def report_ties(dom, cods):
+  dribble.log("** Multiple least-bad matches. Need to find tie-breakers.")
+  dribble.log("   %s -> %s" %
+              (cl.get_unique(dom),
+               [cl.get_unique(cod) for cod in cods]))
 
 # ---- Find ad hoc splits and merges based on multimatches.
 
 def intensional_alignment(matches):
-  result = {}
+  result = art.Alignment()
 
   incoming = index_by_target(matches)
 
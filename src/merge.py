@@ -14,12 +14,13 @@
 import checklist as cl
 import relation as rel
 import dribble
+import traverse
 
 def merge_checklists(A, B, al):
   parents = {}
   roots = []
   def half_compute_parents(check, inject, al):
-    def process(node):
+    for node in traverse.preorder(cl.get_roots(check), cl.get_children):
       merged = inject(node, al)
       if not merged in parents:
         p = merged_parent(merged, al)
@@ -34,10 +35,6 @@ def merge_checklists(A, B, al):
             dribble.log("# No merge(%s)" % cl.get_unique(node))
           if not merged in roots:
             roots.append(merged)
-      for child in cl.get_children(node):
-        process(child)
-    for root in cl.get_roots(check):
-      process(root)
   half_compute_parents(B, inject_B, al)
   half_compute_parents(A, inject_A, al)    # these will not override
   return (parents, roots)
@@ -4,7 +4,8 @@
  extends the scientific name) into the taxon record.
 
  python3 ncbi_to_dwca.py from to
-   'from' is a directory containing .dmp files from ncbi
+   'from' is a directory containing .dmp files from ncbi, or the
+     taxdmp zip file itself
    'to' is a directory that will contain files for DwCA contents
 
  E.g.
@@ -13,6 +14,8 @@
 
 import sys, os, csv, argparse
 
+import dwca
+
 def main(indir, outpath):
   assert os.path.exists(indir)
   accepteds = read_accepteds(os.path.join(indir, "nodes.dmp"))
@@ -30,8 +33,8 @@ def write_row(writer,
                    taxonomicStatus, nomenclaturalStatus])
 
 def emit_dwc(accepteds, synonyms, scinames, authorities, merged, outpath):
-  outdir = os.path.basename(outpath)
-  if not os.path.isdir(outdir): os.mkdir(outdir)
+  outdir = os.path.dirname(outpath)
+  if outdir and not os.path.isdir(outdir): os.mkdir(outdir)
   (delimiter, quotechar, mode) = csv_parameters(outpath)
   print ("Writing", outpath)
   with open(outpath, "w") as outfile:
@@ -110,7 +113,7 @@ def collate_names(names, accepteds):
 def read_accepteds(nodes_path):
   accepteds = []
   # Read the nodes file
-  with open(nodes_path, "r") as infile:
+  with dwca.open_text(nodes_path) as infile:
     for row in csv.reader(infile,
                           delimiter="\t",
                           quotechar="\a",
@@ -126,7 +129,7 @@ def read_accepteds(nodes_path):
 def read_names(names_path):
   names = []
   # Read the names file
-  with open(names_path, "r") as infile:
+  with dwca.open_text(names_path) as infile:
     # Depends on names being grouped by taxa
     previous_id = None
     spin = -1
@@ -148,7 +151,7 @@ def read_names(names_path):
 def read_merged(merged_path):
   merged = []
   # Read the merged file
-  with open(merged_path, "r") as infile:
+  with dwca.open_text(merged_path) as infile:
     for row in csv.reader(infile,
                           delimiter="\t",
                           quotechar="\a",
@@ -170,7 +173,7 @@ def csv_parameters(path):
 
 if __name__ == '__main__':
   parser = argparse.ArgumentParser()
-  parser.add_argument('dump', help='directory containing taxdump files')
+  parser.add_argument('dump', help='directory or zip file containing taxdump files')
   parser.add_argument('--out', help='where to store the DwC version')
   args = parser.parse_args()
   main(args.dump, args.out)
@@ -0,0 +1,173 @@
+# Particle sets: which tipward matches lie below a node, as bitsets
+
+# A particle is a tipward node that has a cross-mrca (see
+# alignment.tipward and alignment.analyze_cross_mrcas); its partner is
+# its cross-mrca, in the other checklist.  Comparing a node with a
+# node of the other checklist by their particles would take a walk
+# over the other node's subtree; with the particles below each node
+# kept as a bitset (built once, bottom up), it's a few operations on
+# integers: the RCC5 relation between them (relation), and a pair of
+# witnesses to it (witnesses).
+
+# The particles of one checklist are numbered in the order of their
+# partners' sequence numbers (preorder) in the other.  Then the
+# particles whose partners are in a given node's subtree are a range
+# of numbers, found by bisection.  The particles below a node of their
+# own checklist are a bitset (base, bits): particle base + i is there
+# if bit i of bits is set.  These are made on first use, bottom up,
+# and kept.
+
+# A node with no cross-mrca has no particles, as far as this is
+# concerned (see alignment.extensional_match), even if there are
+# tipward nodes below it.
+
+import bisect
+
+import checklist as cl
+import relation as rel
+import traverse
+
+class Particles:
+  def __init__(self, checklist, tipwards, xmrcas):
+    self.xmrcas = xmrcas
+    mine = sorted((cl.get_sequence_number(xmrcas[t]), t)
+                  for t in tipwards
+                  if t in xmrcas and cl.get_checklist(t) == checklist)
+    # Partners' sequence numbers, and the particles themselves, by number
+    self.numbers = [number for (number, _) in mine]
+    self.particles = [t for (_, t) in mine]
+    self.index = {t: i for (i, (_, t)) in enumerate(mine)}
+    self.sets = {}              # node -> (base, bits), or None if empty
+    self.ranges = (None, None, None)   # last node, its range, ancestors' ranges
+
+  def __len__(self):
+    return len(self.numbers)
+
+  # The particles below conode (of this checklist), as (base, bits)
+
+  def particle_set(self, conode):
+    if conode in self.sets: return self.sets[conode]
+    sets = self.sets
+    xmrcas = self.xmrcas
+    index = self.index
+    def enter(node, passed):
+      if node in sets or not node in xmrcas or node in index:
+        return traverse.prune
+    def leave(node, results):
+      if node in sets: return sets[node]
+      if not node in xmrcas:
+        result = None
+      elif node in index:
+        result = (index[node], 1)
+      else:
+        result = union([r for r in results if r != None])
+      sets[node] = result
+      return result
+    traverse.walk([conode], cl.get_children, pre=enter, post=leave)
+    return sets[conode]
+
+  # The range of numbers of the particles whose partners are in node's
+  # subtree, and the ranges of those whose partners are node's proper
+  # ancestors (those are neither in node nor disjoint from it).
+
+  def node_ranges(self, node):
+    (last, span, above) = self.ranges
+    if node != last:
+      checklist = cl.get_checklist(node)
+      row = node - checklist.first_uid
+      numbers = self.numbers
+      span = (bisect.bisect_left(numbers, checklist.sequence_numbers[row]),
+              bisect.bisect_left(numbers, checklist.sequence_ends[row]))
+      above = []
+      ancestor = cl.get_parent(node)
+      while ancestor != cl.forest_tnu:
+        number = cl.get_sequence_number(ancestor)
+        (lo, hi) = (bisect.bisect_left(numbers, number),
+                    bisect.bisect_right(numbers, number))
+        if lo < hi: above.append((lo, hi))
+        ancestor = cl.get_parent(ancestor)
+      self.ranges = (node, span, above)
+    return (span, above)
+
+  # (base, inside, outside): conode's particles whose partners are in
+  # node, and those whose partners are disjoint from node, as bits
+  # over base.  Particles whose partners are node's proper ancestors
+  # are in neither.
+
+  def masks(self, node, conode):
+    s = self.particle_set(conode)
+    if s == None: return (0, 0, 0)
+    ((lo, hi), above) = self.node_ranges(node)
+    (base, bits) = s
+    inside = bits & range_mask(lo - base, hi - base)
+    outside = bits & ~inside
+    for (alo, ahi) in above:
+      if not outside: break
+      outside &= ~range_mask(alo - base, ahi - base)
+    return (base, inside, outside)
+
+  # (in, out): whether conode has a particle whose partner is in node,
+  # and whether it has one whose partner is disjoint from node
+
+  def flags(self, node, conode):
+    (_, inside, outside) = self.masks(node, conode)
+    return (inside != 0, outside != 0)
+
+  # (x, y): a particle below conode whose partner is in node, and one
+  # whose partner is disjoint from node (None if there's no such).
+  # Each is the lowest numbered of its kind.
+
+  def witnesses(self, node, conode):
+    (base, inside, outside) = self.masks(node, conode)
+    return (self.particle(base, inside), self.particle(base, outside))
+
+  def particle(self, base, bits):
+    if not bits: return None
+    return self.particles[base + (bits & -bits).bit_length() - 1]
+
+def union(sets):
+  if not sets: return None
+  base = min(b for (b, _) in sets)
+  bits = 0
+  for (b, more) in sets:
+    bits |= more << (b - base)
+  return (base, bits)
+
+# Bits lo up to (not including) hi, clipped at 0
+
+def range_mask(lo, hi):
+  lo = max(lo, 0)
+  if hi <= lo: return 0
+  return ((1 << (hi - lo)) - 1) << lo
+
+# The particle sets of two checklists, each used when comparing with a
+# node of the other
+
+class ParticleSets:
+  def __init__(self, A, B, tipwards, xmrcas):
+    self.by_checklist = {A: Particles(A, tipwards, xmrcas),
+                         B: Particles(B, tipwards, xmrcas)}
+
+  def get(self, conode):
+    return self.by_checklist[cl.get_checklist(conode)]
+
+  def flags(self, node, conode):
+    return self.get(conode).flags(node, conode)
+
+  def witnesses(self, node, conode):
+    return self.get(conode).witnesses(node, conode)
+
+  # RCC5 relation of node to conode (in the other checklist) by their
+  # particles: each one's particles are split into those inside the
+  # other and those outside it.  None if conode has no particles that
+  # are either.
+
+  def relation(self, node, conode):
+    (_, cin, cout) = self.get(conode).masks(node, conode)
+    if not cin:
+      return rel.disjoint if cout else None
+    (_, nin, nout) = self.get(node).masks(conode, node)
+    if cout and nout: return rel.conflict
+    if cout: return rel.lt
+    if nout: return rel.gt
+    return rel.eq
@@ -6,6 +6,7 @@ import sys, csv
 import argparse
 
 import checklist as cl
+import table
 import relation as rel
 import articulation as art
 import eulerx
@@ -13,6 +14,7 @@ import alignment
 import changes
 import merge
 import dribble
+import traverse
 import diff
 
 # A is lower priority, B is higher
@@ -23,16 +25,20 @@ def main(c1, c1_tag, c2, c2_tag, out, format):
   with open(dribpath, "w") as dribfile:
     dribble.dribble_file = dribfile
     dribble.log ("\nLogging to %s" % (dribpath,))
-    A = cl.read_checklist(c1, c1_tag + ".", "low-checklist")
-    B = cl.read_checklist(c2, c2_tag + ".", "high-checklist")
-    dribble.log ("Node counts: %s %s" % (len(A.get_all_nodes()), len(B.get_all_nodes())))
-    # Map each B to a corresponding A
-    dribble.log ("Aligning ...")
-    (al, xmrcas) = alignment.align(B, A)
-    dribble.log("  ... finished aligning; %s articulations\n" %
-                len(al))
-    # Where do xmrcas come from?
-    write_report(A, B, al, xmrcas, format, out)
+    # Everything read for this comparison is released at the end
+    with table.session():
+      A = cl.read_checklist(c1, c1_tag + ".", "low-checklist")
+      B = cl.read_checklist(c2, c2_tag + ".", "high-checklist")
+      dribble.log ("Node counts: %s %s" % (len(A.get_all_nodes()), len(B.get_all_nodes())))
+      # Map each B to a corresponding A
+      dribble.log ("Aligning ...")
+      (al, xmrcas) = alignment.align(B, A)
+      dribble.log("  ... finished aligning; %s articulations\n" %
+                  len(al))
+      # Where do xmrcas come from?
+      write_report(A, B, al, xmrcas, format, out)
+      cl.report_memos(A)
+      cl.report_memos(B)
     dribble.dribble_file = None
 
 def write_report(A, B, al, xmrcas, format, outpath):
@@ -54,12 +60,8 @@ def write_report(A, B, al, xmrcas, format, outpath):
 
 def assign_ids(parents, roots, children):
   id_table = {}
-  def process(node):
+  for node in traverse.preorder(roots, lambda node: children.get(node, [])):
     id_table[node] = len(id_table) + 1
-    for child in children.get(node, []):
-      process(child)
-  for root in roots:
-    process(root)
   return id_table
 
 canonical_name = cl.field("canonicalName")
@@ -94,6 +96,10 @@ def report(A, B, al, roots, parents, outfile):
   write_header(writer)
   children = cl.invert_dict(parents)
   all_props = set.intersection(set(A.properties), set(B.properties))
+  shared = [(x, y) for (x, y) in list(parents) + roots if x and y]
+  changes.remember_differences([x for (x, _) in shared],
+                               [y for (_, y) in shared])
+  dribble.log("# Compared %s shared nodes column by column" % len(shared))
   any_descendant_differs = find_changed_subtrees(roots, children, all_props)
   id_table = assign_ids(parents, roots, children)
 
@@ -157,14 +163,13 @@ def report(A, B, al, roots, parents, outfile):
     report_one_articulation(id, op, nodiff, dif, x, y, z, ar, note, writer, indent)
     return different
 
+  # Returns the indent for mnode's children
   def process(mnode, indent):
     different = taxon_report(mnode, indent)
-    jndent = indent + "—"    # em dash
-    if different:
-      for child in children.get(mnode, []):
-        process(child, jndent)
-  for root in roots:
-    process(root, "")
+    if not different: return traverse.prune
+    return indent + "—"    # em dash
+  traverse.walk(roots, lambda mnode: children.get(mnode, []),
+                pre=process, start="")
 
 def report_one_articulation(id, op, nodiff, dif, x, y, z, ar, note, writer, indent):
   (ix, ux, rankx) = node_data(x)
@@ -200,7 +205,7 @@ def node_data(node):
 
 def find_changed_subtrees(roots, children, all_props):
   any_descendant_differs = {}
-  def process(node):
+  def process(node, child_changes):
     node_changed = False
     (x, y) = node
     if not x or not y:
@@ -209,15 +214,13 @@ def find_changed_subtrees(roots, children, all_props):
       comparison = changes.differences(x, y, all_props)
       if not changes.same(comparison):
         node_changed = True
-    descendant_changed = False
-    for child in children.get(node, []):
-      if process(child):
-        descendant_changed = True
+    descendant_changed = any(child_changes)
     if descendant_changed:
       any_descendant_differs[node] = True
     return descendant_changed or node_changed
-  for root in roots:
-    c = process(root)
+  for (root, c) in zip(roots,
+                       traverse.walk(roots, lambda node: children.get(node, []),
+                                     post=process)):
     if c: any_descendant_differs[root] = c
   dribble.log("# %s nodes in merge have some change in their descendants" %
               (len(any_descendant_differs)))
@@ -233,7 +236,23 @@ if __name__ == '__main__':
   parser.add_argument('--high-tag', default="B")
   parser.add_argument('--out', help='file name for report', default='report.csv')
   parser.add_argument('--format', help='report format', default='ad-hoc')
+  parser.add_argument('--no-cache', action='store_true',
+                      help="don't read or write .cldx checklist caches")
+  parser.add_argument('--jobs', type=int, default=1,
+                      help='number of processes to use for reading '
+                           'checklists and matching them')
+  parser.add_argument('--properties',
+                      help='comma-separated names of properties to compare '
+                           'besides the required ones (default: all known)')
+  parser.add_argument('--lazy', action='store_true',
+                      help='parse only key columns of TSV checklists up front')
   args = parser.parse_args()
+  if args.no_cache: cl.use_cache = False
+  cl.jobs = args.jobs
+  cl.lazy = args.lazy
+  if args.properties != None:
+    cl.properties = [cl.field(name)
+                     for name in args.properties.split(",") if name]
   main(args.low, args.low_tag, args.high, args.high_tag,
        args.out, args.format)
 
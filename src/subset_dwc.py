@@ -3,6 +3,9 @@
 
  python3 subset_dwc.py [--taxonomy tax_dwc] source_dwc out_dwc
 
+ The source (and taxonomy) may be a DwC-A directory or zip file, in
+ which case its taxon file is used.
+
  Assumption: every accepted record has a taxonID
 """
 
@@ -10,6 +13,9 @@ debug = False
 
 import sys, os, csv, argparse
 
+import dwca
+import traverse
+
 def main(checklist, tax_path, root_id, outpath):
   topo = read_topology(tax_path)
   all = closure(topo, root_id)
@@ -18,8 +24,9 @@ def main(checklist, tax_path, root_id, outpath):
 def write_subset(checklist, root_id, all, topo, outpath):
   print("Writing subset to %s" % outpath, flush=True)
 
+  checklist = dwca.taxon_path(checklist)
   (delimiter, quotechar, mode) = csv_parameters(checklist)
-  with open(checklist, "r") as infile:
+  with dwca.open_text(checklist) as infile:
     reader = csv.reader(infile, delimiter=delimiter, quotechar=quotechar, quoting=mode)
     head = next(reader)
 
@@ -43,26 +50,24 @@ def write_subset(checklist, root_id, all, topo, outpath):
 def closure(topo, root_id):
   print("Computing transitive closure starting from %s" % root_id, flush=True)
   all = {}
-  empty = []
-  def descend(id):
-    if not id in all:
-      all[id] = True
-      if id in topo:
-        (children, synonyms, _) = topo[id]
-        for child in children:
-          descend(child)
-        for syn in synonyms:
-          descend(syn)
-  descend(root_id)
+  def descend(id, passed):
+    if id in all: return traverse.prune
+    all[id] = True
+  def successors(id):
+    if not id in topo: return []
+    (children, synonyms, _) = topo[id]
+    return children + synonyms
+  traverse.walk([root_id], successors, pre=descend)
   print ("  Nodes in transitive closure: %s" % len(all))
   return all
 
 def read_topology(tax_path):
   # Keyed by taxon id
   topo = {}
+  tax_path = dwca.taxon_path(tax_path)
   (delimiter, quotechar, mode) = csv_parameters(tax_path)
   counter = 0
-  with open(tax_path, "r") as infile:
+  with dwca.open_text(tax_path) as infile:
     print("Scanning %s to obtain topology" % tax_path, flush=True)
     reader = csv.reader(infile, delimiter=delimiter, quotechar=quotechar, quoting=mode)
     head = next(reader)
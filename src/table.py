@@ -1,14 +1,47 @@
-import csv
+import os, io, csv, bisect, time, contextlib, mmap, array
+import multiprocessing
 import property
+import column
+import index
+import dwca
+import dribble
 
 # A table can be read and/or written
 # If a table is populated it can be indexed
 # The columns of a table have labels
 
+# Records are stored column by column: one compact column per known
+# property (see column.py).  Columns for unrecognized labels are not
+# kept, nor are columns for properties outside the table's projection
+# (if it has one).
+
+# How each property is stored.  Identifiers start out as integers and
+# fall back to text if some value isn't one (e.g. NCBI synonym ids like
+# '9443.1').  Anything not listed is text.
+
+column_kinds = {
+  "taxonID": "int",
+  "parentNameUsageID": "int",
+  "acceptedNameUsageID": "int",
+  "ncbi_id": "int",
+  "gbif_id": "int",
+  "EOLid": "int",
+  "taxonRank": "code",
+  "verbatimTaxonRank": "code",
+  "taxonomicStatus": "code",
+  "nomenclaturalStatus": "code",
+  "nameAccordingToID": "code",
+}
+
+batch_size = 10000
+
 class Table:
   def __init__(self):
-    self.record_uids = []
-    pass
+    self.record_uids = range(0)
+    self.row_count = 0
+    self.index_time = 0
+    self.index_loaders = {}     # prop uid -> function returning index keys
+    self.projection = None      # set of prop uids to keep, None = all known
 
   def header(self):
     return self.header
@@ -22,55 +55,314 @@ class Table:
     assert not "," in header[0]
     self.header = header
     self.position_index = [None] * property.number_of_properties
-    self.methods = [not_present] * property.number_of_properties
-    # TBD: If there is a meta.xml, get the properties that way.
+    self.columns = [None] * property.number_of_properties
     # NB: by_name returns None if label is unrecognized
     self.properties = [property.by_name(label) for label in header]
+    if self.projection != None:
+      self.properties = [prop if prop and prop.uid in self.projection else None
+                         for prop in self.properties]
     self.indexes = [None] * property.number_of_properties
     for position in range(len(header)):
       # position is column position within record (table specific)
       prop = self.properties[position]
       if prop:
         self.position_index[prop.uid] = position
-        self.methods[prop.uid] = self.fetcher(prop, position)
+        kind = column_kinds.get(prop.pet_name, "text")
+        self.columns[prop.uid] = column.new_column(kind)
+    # (position, property uid) for every column we keep
+    self.stored = [(self.position_index[prop.uid], prop.uid)
+                   for prop in property.properties_by_specificity
+                   if self.position_index[prop.uid] != None]
 
-  def fetcher(self, prop, position):
-    def fetch(r):
-      if r[position] == '': return None
-      return r[position]
-    return fetch
+  # Fields beyond this position aren't kept, so needn't be split out
 
-  def populate_from_generator(self, record_generator):
+  def field_limit(self):
+    return max((position for (position, _) in self.stored), default=-1) + 1
+
+  def populate_from_generator(self, record_generator, indexed = ()):
     self.process_header(next(record_generator))
-    for record in record_generator:
-      id = _register(record, self)
-      self.record_uids.append(id)
+    self.populate_from_records(record_generator, indexed)
+
+  # Properties in 'indexed' are indexed as the records are read, so
+  # that all the indexes get built in one pass.
+
+  def populate_from_records(self, records, indexed = ()):
+    self.index_time = 0
+    for prop in indexed:
+      col = self.columns[prop.uid]
+      if col != None:
+        self.indexes[prop.uid] = index.Index(col)
+    batch = []
+    for record in records:
+      batch.append(record)
+      if len(batch) >= batch_size:
+        self.add_records(batch)
+        batch = []
+    self.add_records(batch)
+    _register(self)
+    self.report_indexes()
 
-  def populate_from_file(self, inpath):
-    # Look for a meta.xml file in same directory?
+  # Add a batch of records (lists of strings) to the columns
+
+  def add_records(self, batch):
+    for (position, uid) in self.stored:
+      try:
+        values = [record[position] for record in batch]
+      except IndexError:
+        # Short rows; missing fields are empty
+        values = [record[position] if position < len(record) else ''
+                  for record in batch]
+      col = self.columns[uid]
+      generalized = False
+      if not col.extend(values):
+        col = col.generalize()
+        assert col.extend(values)
+        self.columns[uid] = col
+        generalized = True
+      idx = self.indexes[uid]
+      if idx != None:
+        start = time.perf_counter()
+        if generalized:
+          # Keys change representation; start over
+          self.indexes[uid] = index.build_index(col)
+        else:
+          idx.add(self.row_count,
+                  col.keys(self.row_count, len(col)) if col.kind == "int"
+                  else values)
+        self.index_time += time.perf_counter() - start
+    self.row_count += len(batch)
+
+  # The file may be in a zip archive (see dwca.py).  If there's a
+  # meta.xml describing it, columns are identified by its terms rather
+  # than by the header row.
+  # With jobs > 1, large files are parsed in parallel (see below); a
+  # file in an archive can't be split into chunks, so it's read
+  # serially.
+
+  def populate_from_file(self, inpath, indexed = (), jobs = 1):
+    meta = dwca.find_meta(inpath)
+    if (jobs > 1 and not dwca.in_archive(inpath) and
+        os.path.getsize(inpath) >= jobs * min_chunk_size):
+      if self.populate_in_parallel(inpath, indexed, jobs, meta):
+        return
+      dribble.log("# Records span lines in %s; reading it serially" % inpath)
     (delim, qc, qu) = csv_parameters(inpath)
     # print("# Parameters %s %s %s" % (delim, qc, qu))
-    with open(inpath, "r") as infile:
+    with dwca.open_text(inpath) as infile:
       reader = csv.reader(infile, delimiter=delim, quotechar=qc, quoting=qu)
-      self.populate_from_generator(reader)
+      self.process_header(read_header(reader, meta))
+      if qu == csv.QUOTE_NONE:
+        # No quoting, so splitting lines is enough, and unwanted
+        # trailing fields can be left unsplit
+        reader = split_lines(infile, self.field_limit())
+      self.populate_from_records(reader, indexed)
+
+  # Split the file into chunks at line boundaries, parse the chunks into
+  # columns in a process pool, and concatenate the results in file
+  # order, so records get the same uids a serial read would give them.
+  # For TSV (no quoting) every newline ends a record.  For CSV, a quoted
+  # field might contain a newline; if any chunk has a record spanning
+  # lines, we give up (returns False) and the caller reads serially.
+
+  def populate_in_parallel(self, inpath, indexed, jobs, meta = None):
+    start = time.perf_counter()
+    with open(inpath, "r") as infile:
+      (delim, qc, qu) = csv_parameters(inpath)
+      header = read_header(csv.reader(infile, delimiter=delim, quotechar=qc,
+                                      quoting=qu),
+                           meta)
+    header_lines = meta["header_lines"] if meta else 1
+    tasks = [(inpath, begin, end, header, self.projection)
+             for (begin, end) in chunk_boundaries(inpath, jobs * 4, header_lines)]
+    with multiprocessing.Pool(jobs) as pool:
+      pieces = pool.map(read_chunk, tasks)
+    if not all(ok for (ok, _, _) in pieces):
+      return False
+    self.process_header(header)
+    for (_, uid) in self.stored:
+      self.columns[uid] = \
+        column.concatenate([columns[uid] for (_, _, columns) in pieces])
+    self.row_count = sum(count for (_, count, _) in pieces)
+    dribble.log("# Read %s records from %s in %s chunks, %s jobs, in %.2fs" %
+                (self.row_count, inpath, len(tasks), jobs,
+                 time.perf_counter() - start))
+    _register(self)
+    self.build_indexes(indexed)
+    return True
+
+  # Lazy reading: map the file into memory, store only the columns for
+  # 'eager' properties, and leave the other fields in the file, to be
+  # split out of a record's line when get_value asks for one of them
+  # (column.LazyColumn).  Only eager columns are indexed as the file is
+  # read; indexes for other properties are built when first needed.
+  # Works for unquoted (TSV) files; anything else is read normally.
+
+  def populate_lazily(self, inpath, eager, indexed = ()):
+    (delim, qc, qu) = csv_parameters(inpath)
+    if qu != csv.QUOTE_NONE or dwca.in_archive(inpath):
+      return self.populate_from_file(inpath, indexed)
+    start = time.perf_counter()
+    meta = dwca.find_meta(inpath)
+    with open(inpath, "rb") as infile:
+      if meta == None:
+        header = str(infile.readline(), 'utf-8').rstrip("\r\n").split("\t")
+      else:
+        for i in range(meta["header_lines"]):
+          infile.readline()
+        header = dwca.labels(meta)
+      self.process_header(header)
+      stored = self.stored
+      eager_uids = set(prop.uid for prop in eager)
+      self.stored = [(position, uid) for (position, uid) in stored
+                     if uid in eager_uids]
+      offsets = array.array('q', [infile.tell()])
+      limit = self.field_limit()
+      def records():
+        for line in infile:
+          offsets.append(offsets[-1] + len(line))
+          yield str(line, 'utf-8').rstrip("\r\n").split("\t", limit)
+      self.populate_from_records(records(),
+                                 [prop for prop in indexed
+                                  if prop.uid in eager_uids])
+      if self.row_count > 0:
+        self.mapping = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        lines = column.Lines(memoryview(self.mapping), offsets)
+      else:
+        lines = column.Lines(b"", offsets)
+    for (position, uid) in stored:
+      if not uid in eager_uids:
+        self.columns[uid] = column.LazyColumn(lines, position)
+    dribble.log("# Read %s records from %s lazily (%s of %s columns) in %.2fs" %
+                (self.row_count, inpath, len(self.stored), len(stored),
+                 time.perf_counter() - start))
+    self.stored = stored
+
+  def is_lazy(self):
+    return any(col != None and col.kind == "lazy" for col in self.columns)
+
+  # Build indexes for several properties at once, one column scan each
+
+  def build_indexes(self, props):
+    start = time.perf_counter()
+    for prop in props:
+      col = self.columns[prop.uid]
+      if col != None and self.indexes[prop.uid] == None:
+        self.indexes[prop.uid] = index.build_index(col)
+        self.indexes[prop.uid].base = self.first_uid
+    self.index_time += time.perf_counter() - start
+    self.report_indexes()
+
+  def report_indexes(self):
+    built = [idx for idx in self.indexes if idx != None]
+    if built:
+      dribble.log("# Indexed %s columns of %s records in %.2fs: %s keys, ~%s KB" %
+                  (len(built), self.row_count, self.index_time,
+                   sum(len(idx) for idx in built),
+                   sum(idx.size_in_bytes() for idx in built) // 1024))
+
+  # Reconstruct a record, with None for columns that weren't kept
+
+  def get_record(self, row):
+    record = [None] * len(self.header)
+    for (position, uid) in self.stored:
+      record[position] = self.columns[uid].get(row)
+    return record
+
+  # Drop the table's contents (when its registry is released)
+
+  def release(self):
+    self.columns = None
+    self.indexes = None
+    self.index_loaders = {}
+    self.mapping = None
+    self.record_uids = range(0)
 
   # Create indexes on demand.  Position is column position specific to
   # this table, which can be determined using get_position.
 
   def get_index(self, prop):
-    if self.methods[prop.uid] == not_present: return {}
+    col = self.columns[prop.uid]
+    if col == None: return {}
     if self.indexes[prop.uid] == None:
-      index = {}
-      for id in self.record_uids:
-        value = get_value(id, prop)
-        if value != None:
-          if value in index:
-            index[value].append(id)
-          else:
-            index[value] = [id]
-      self.indexes[prop.uid] = index
+      loader = self.index_loaders.pop(prop.uid, None)
+      if loader:
+        idx = index.Index(col)
+        idx.rows = loader()
+      else:
+        idx = index.build_index(col)
+      idx.base = self.first_uid
+      self.indexes[prop.uid] = idx
     return self.indexes[prop.uid]
 
+# ---------- Parallel reading
+
+min_chunk_size = 1 << 20
+
+# Byte ranges covering everything after the header line(s), each
+# ending at a newline
+
+def chunk_boundaries(path, count, header_lines = 1):
+  size = os.path.getsize(path)
+  with open(path, "rb") as infile:
+    for i in range(header_lines):
+      infile.readline()
+    begin = infile.tell()
+    step = max((size - begin) // count, 1)
+    boundaries = []
+    while begin < size:
+      infile.seek(min(begin + step, size))
+      if infile.tell() < size: infile.readline()
+      end = infile.tell()
+      boundaries.append((begin, end))
+      begin = end
+  return boundaries
+
+# Runs in a worker process.  Returns (ok, record count, columns).
+
+def read_chunk(task):
+  (path, begin, end, header, projection) = task
+  with open(path, "rb") as infile:
+    infile.seek(begin)
+    data = infile.read(end - begin)
+  text = io.TextIOWrapper(io.BytesIO(data)).read()
+  (delim, qc, qu) = csv_parameters(path)
+  piece = Table()
+  piece.projection = projection
+  piece.process_header(header)
+  if qu == csv.QUOTE_NONE:
+    reader = split_lines(io.StringIO(text), piece.field_limit())
+  else:
+    reader = csv.reader(io.StringIO(text),
+                        delimiter=delim, quotechar=qc, quoting=qu)
+  batch = []
+  for record in reader:
+    batch.append(record)
+    if len(batch) >= batch_size:
+      piece.add_records(batch)
+      batch = []
+  piece.add_records(batch)
+  lines = text.count("\n") + (0 if text.endswith("\n") else 1)
+  if piece.row_count != lines:
+    return (False, 0, None)
+  return (True, piece.row_count, piece.columns)
+
+# The header row, or, given a meta.xml description, labels derived
+# from it (skipping any header lines)
+
+def read_header(reader, meta):
+  if meta == None:
+    return next(reader)
+  for i in range(meta["header_lines"]):
+    next(reader)
+  return dwca.labels(meta)
+
+# Records of an unquoted (TSV) file: only the first 'limit' fields are
+# split apart; anything after that is left in one piece.
+
+def split_lines(lines, limit):
+  for line in lines:
+    yield line.rstrip("\n").split("\t", limit)
+
 def csv_parameters(path):
   if ".csv" in path:
     return (",", '"', csv.QUOTE_MINIMAL)
@@ -84,33 +376,90 @@ def read_table(specifier):
 
 # Record registry
 
+# Every record has a uid unique across all tables.  The records of a
+# table get consecutive uids, so the registry only needs to remember
+# where each table's block starts.
+
+# Records belong to the current registry.  A session (see below) gets
+# a fresh registry, and releases it, with all its tables, when it
+# ends; uids then start over from 1.
+
 def is_record(x):
   return isinstance(x, int) and x > 0
 
-_registry = ["there is no record 0"]
+class Registry:
+  def __init__(self):
+    self.tables = []          # in order of first uid
+    self.first_uids = []      # first uid of each table; there is no record 0
+    self.next_uid = 1
+    self.articulations = None # made during the session; see articulation.py
 
-# We store a pair (record, table) where table is the table that "owns"
-# the record.
+  def register(self, table):
+    table.first_uid = self.next_uid
+    table.record_uids = range(self.next_uid, self.next_uid + table.row_count)
+    for idx in table.indexes:
+      if idx != None: idx.base = self.next_uid
+    self.tables.append(table)
+    self.first_uids.append(self.next_uid)
+    self.next_uid += table.row_count
 
-def record_and_table(record_uid):    # returns (record, table)
-  return _registry[record_uid]
+  def release(self):
+    for table in self.tables:
+      table.release()
+    self.tables.clear()
+    self.first_uids.clear()
+    self.next_uid = 1
+    self.articulations = None
 
-def _register(record, table):
-  record_uid = len(_registry)
-  _registry.append((record, table))
-  return record_uid
+# The current registry, and its lists (for speed in get_value)
+_current = None
+_registry = None
+_first_uids = None
 
-def not_present(record):
-  return None
+def _use(registry):
+  global _current, _registry, _first_uids
+  _current = registry
+  _registry = registry.tables
+  _first_uids = registry.first_uids
 
-def get_value(record_uid, prop):
-  (r, t) = record_and_table(record_uid)
-  val = t.methods[prop.uid](r)
-  return val
+_use(Registry())
+
+_bisect_right = bisect.bisect_right
+
+def _register(table):
+  _current.register(table)
+
+def current_registry():
+  return _current
+
+# E.g. one comparison of two checklists:
+#   with table.session():
+#     A = cl.read_checklist(...)
+#     ...
+# Records from outside the session can't be seen during it.
+
+@contextlib.contextmanager
+def session():
+  outer = _current
+  _use(Registry())
+  try:
+    yield _current
+  finally:
+    _current.release()
+    _use(outer)
 
 def get_table(record_uid):
-  (r, t) = record_and_table(record_uid)
-  return t
+  return _registry[_bisect_right(_first_uids, record_uid) - 1]
+
+def record_and_table(record_uid):    # returns (record, table)
+  t = get_table(record_uid)
+  return (t.get_record(record_uid - t.first_uid), t)
+
+def get_value(record_uid, prop):
+  t = _registry[_bisect_right(_first_uids, record_uid) - 1]
+  col = t.columns[prop.uid]
+  if col == None: return None
+  return col.get(record_uid - t.first_uid)
 
 # ---------- Self-test
 
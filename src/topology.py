@@ -0,0 +1,114 @@
+# Topology: the hierarchy of a checklist as integer arrays
+
+# Built once, after the checklist has been read (and before it's
+# validated; see checklist.validate), from the taxonID,
+# parentNameUsageID and acceptedNameUsageID columns.
+# Afterwards parent, children, accepted, and synonyms are array
+# lookups rather than index lookups on string ids.
+
+# All arrays are by row (position of the record within its table), and
+# hold record uids:
+#   parents          - parent record, or 0 (forest) if none
+#   accepteds        - accepted record of a synonym, 0 for an accepted record
+#   accepted_flags   - 1 if the record is accepted, 0 if it's a synonym
+#   children         - children of row r are
+#                      children[child_starts[r] : child_starts[r+1]]
+#   synonyms         - similarly, with synonym_starts
+
+# The arrays can be saved with the checklist in its cache (see
+# cache.py), as memoryviews work just as well.
+
+import array
+
+names = ["parents", "accepteds", "accepted_flags",
+         "child_starts", "children", "synonym_starts", "synonyms"]
+
+class Topology:
+  def __init__(self, arrays):
+    for name in names:
+      setattr(self, name, arrays[name])
+
+  def arrays(self):
+    return {name: getattr(self, name) for name in names}
+
+# Keys of col's values, as target (a column) would have them.  Integer
+# columns have integer keys, others have strings.
+
+def keys_in(col, target, count):
+  if (col.kind == "int") == (target.kind == "int"):
+    return col.keys(0, count)
+  key_of = target.key_of
+  return [key_of(value) for value in col.values()]
+
+# For each key, the uid of the first row that idx has for it, or 0
+
+def first_uids(idx, keys, base):
+  rows = idx.rows
+  result = array.array('q')
+  append = result.append
+  for key in keys:
+    have = rows.get(key)
+    if have == None:
+      append(0)
+    elif type(have) is int:
+      append(base + have)
+    else:
+      append(base + have[0])
+  return result
+
+# For each key, the uids of all the rows that idx has for it, as
+# (starts, members)
+
+def all_uids(idx, keys, base):
+  rows = idx.rows
+  starts = array.array('q', [0])
+  members = array.array('q')
+  for key in keys:
+    have = rows.get(key)
+    if have != None:
+      if type(have) is int:
+        members.append(base + have)
+      else:
+        members.extend([base + row for row in have])
+    starts.append(len(members))
+  return (starts, members)
+
+def build_topology(tab, taxon_id, parent_id, accepted_id):
+  count = tab.row_count
+  base = tab.first_uid
+  taxon_col = tab.columns[taxon_id.uid]
+  taxon_index = tab.get_index(taxon_id)
+  arrays = {}
+
+  # Parent and accepted: the record whose taxonID is the given id
+  for (prop, name) in [(parent_id, "parents"), (accepted_id, "accepteds")]:
+    col = tab.columns[prop.uid]
+    if col == None:
+      arrays[name] = array.array('q', bytes(8 * count))
+    else:
+      arrays[name] = first_uids(taxon_index,
+                                keys_in(col, taxon_index.column, count),
+                                base)
+
+  # A record is accepted if it has no accepted id (resolved or not)
+  col = tab.columns[accepted_id.uid]
+  if col == None:
+    arrays["accepted_flags"] = array.array('B', [1]) * count
+  else:
+    missing = col.missing_keys
+    arrays["accepted_flags"] = \
+      array.array('B', [key in missing for key in col.keys(0, count)])
+
+  # Children and synonyms: the records whose parent or accepted id is
+  # this record's taxonID
+  for (prop, starts, members) in [(parent_id, "child_starts", "children"),
+                                  (accepted_id, "synonym_starts", "synonyms")]:
+    if tab.columns[prop.uid] == None:
+      (arrays[starts], arrays[members]) = \
+        (array.array('q', bytes(8 * (count + 1))), array.array('q'))
+    else:
+      idx = tab.get_index(prop)
+      (arrays[starts], arrays[members]) = \
+        all_uids(idx, keys_in(taxon_col, idx.column, count), base)
+
+  return Topology(arrays)
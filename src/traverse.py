@@ -0,0 +1,52 @@
+# Tree traversal without recursion
+
+# Deep lineages (GBIF, NCBI) can be thousands of nodes from root to
+# tip, too deep for Python's recursion limit.  These walks keep their
+# own stack instead.
+
+# 'children' is a function from a node to a list of its children, e.g.
+# cl.get_children, or a dict's get for a merged tree.  A walk covers
+# the subtrees rooted at the given roots, so passing [node] restricts it
+# to node's subtree.
+
+# Returned by a pre function to say: don't go into this node's children
+
+prune = object()
+
+_done = object()
+
+# Visits nodes in preorder and postorder.
+#   pre(node, passed) is called on the way down, where passed is what
+#     pre returned for the node's parent (or 'start', for a root).  If
+#     it returns prune, the node's children are skipped.
+#   post(node, results) is called on the way up, with the list of what
+#     post returned for each of the node's children.
+# Returns the list of post's results for the roots.
+
+def walk(roots, children, pre = None, post = None, start = None):
+  top = []
+  # (node, passed to children, remaining children, children's results)
+  stack = [(None, start, iter(roots), top)]
+  while True:
+    (node, passed, pending, results) = stack[-1]
+    child = next(pending, _done)
+    if child is _done:
+      stack.pop()
+      if not stack: return top
+      if post != None:
+        stack[-1][3].append(post(node, results))
+      continue
+    down = pre(child, passed) if pre != None else None
+    if down is prune:
+      stack.append((child, None, iter(()), []))
+    else:
+      stack.append((child, down, iter(children(child)), []))
+
+# Nodes in preorder
+
+def preorder(roots, children):
+  stack = list(reversed(roots))
+  while stack:
+    node = stack.pop()
+    yield node
+    stack.extend(reversed(children(node)))